@@ -2,18 +2,41 @@
 # -*- coding: UTF-8 -*-
 
 import argparse
+import asyncio
 import socket
 import os
 import sys
 import struct
+import array
 import time
 import random
+import email.utils
+import mimetypes
+import mmap
+import zlib
+import json
+import csv
+import io
+import contextlib
+import tempfile
+import http.server
+import select
+import signal
+import selectors
+import threading
+import heapq
+import bisect
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
 
 def setupArgumentParser() -> argparse.Namespace:
         parser = argparse.ArgumentParser(
             description='A collection of Network Applications developed for SCC.203.')
-        parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk')
+        parser.set_defaults(func=ICMPPing, hostname='lancaster.ac.uk', count=None, timeout=None,
+                            targets=None, targets_file=None, interval=1, max_rate=0, kernel_timestamps=False,
+                            report_interval=0, output='text', output_file=None,
+                            size=56, pmtu=False)
         subparsers = parser.add_subparsers(help='sub-command help')
         
         parser_p = subparsers.add_parser('ping', aliases=['p'], help='run ping')
@@ -23,6 +46,22 @@ def setupArgumentParser() -> argparse.Namespace:
         parser_p.add_argument('timeout', nargs='?',
                               type=int,
                               help='maximum timeout before considering request lost')
+        parser_p.add_argument('--targets', nargs='+', default=None,
+                              help='further hosts to ping at the same time')
+        parser_p.add_argument('--targets-file', type=str, default=None,
+                              help='file listing further hosts to ping at the same time, one per line')
+        parser_p.add_argument('--interval', type=float, default=1,
+                              help='seconds between two probes to the same target when pinging several targets')
+        parser_p.add_argument('--max-rate', type=float, default=0,
+                              help='maximum probes per second sent across all targets (0 for no limit)')
+        parser_p.add_argument('--report-interval', type=float, default=0,
+                              help='print the statistics so far every this many seconds (0 for only at the end)')
+        parser_p.add_argument('--kernel-timestamps', action='store_true',
+                              help='time replies with kernel receive timestamps (SO_TIMESTAMPNS)')
+        parser_p.add_argument('--size', type=payloadSize, default=56,
+                              help='bytes of payload carried by every echo request')
+        parser_p.add_argument('--pmtu', action='store_true',
+                              help='find the path MTU to every target with DF-flagged probes instead of pinging')
         parser_p.set_defaults(func=ICMPPing)
 
         parser_t = subparsers.add_parser('traceroute', aliases=['t'],
@@ -30,45 +69,457 @@ def setupArgumentParser() -> argparse.Namespace:
         parser_t.add_argument('hostname', type=str, help='host to traceroute towards')
         parser_t.add_argument('timeout', nargs='?', type=int,
                               help='maximum timeout before considering request lost')
-        parser_t.add_argument('protocol', nargs='?', type=str,
+        parser_t.add_argument('protocol', nargs='?', type=str.lower, choices=('icmp', 'udp'),
                               help='protocol to send request with (UDP/ICMP)')
+        parser_t.add_argument('--parallel', action='store_true',
+                              help='send the probes of every hop at once instead of one hop at a time')
+        parser_t.add_argument('--max-hops', type=int, default=30,
+                              help='maximum number of hops probed')
+        parser_t.add_argument('--kernel-timestamps', action='store_true',
+                              help='time replies with kernel receive timestamps (SO_TIMESTAMPNS)')
         parser_t.set_defaults(func=Traceroute)
 
         parser_w = subparsers.add_parser('web', aliases=['w'], help='run web server')
         parser_w.set_defaults(port=8080)
         parser_w.add_argument('port', type=int, nargs='?',
                               help='port number to start web server listening on')
+        addServerArguments(parser_w)
+        parser_w.add_argument('--idle-timeout', type=float, default=5,
+                              help='seconds a persistent connection may stay idle before it is closed')
+        parser_w.add_argument('--max-requests', type=int, default=100,
+                              help='maximum number of requests answered on one persistent connection')
+        parser_w.add_argument('--cache-size', type=int, default=0,
+                              help='bytes of memory used to cache small hot files (0 disables the cache)')
+        parser_w.add_argument('--cache-file-limit', type=int, default=64 * 1024,
+                              help='largest file in bytes that is kept in the file cache')
         parser_w.set_defaults(func=WebServer)
 
         parser_x = subparsers.add_parser('proxy', aliases=['x'], help='run proxy')
         parser_x.set_defaults(port=8000)
         parser_x.add_argument('port', type=int, nargs='?',
                               help='port number to start web server listening on')
+        parser_x.add_argument('--max-object-size', type=int, default=1 << 20,
+                              help='largest response in bytes that is kept in the cache')
+        parser_x.add_argument('--cache-size', type=int, default=64 << 20,
+                              help='bytes of memory used to cache responses')
+        parser_x.add_argument('--default-ttl', type=int, default=300,
+                              help='seconds a response without Cache-Control or Expires headers stays fresh')
+        parser_x.add_argument('--disk-cache', type=str, default=None,
+                              help='directory of a persistent cache tier kept across restarts')
+        parser_x.add_argument('--disk-cache-size', type=int, default=1 << 30,
+                              help='bytes of disk used by the persistent cache tier')
+        parser_x.add_argument('--pool-idle', type=int, default=4,
+                              help='idle keep-alive connections kept open to each origin')
+        parser_x.add_argument('--pool-max', type=int, default=16,
+                              help='maximum number of connections open to one origin at a time')
+        parser_x.add_argument('--pool-idle-timeout', type=float, default=30,
+                              help='seconds an idle origin connection is kept before it is closed')
+        addServerArguments(parser_x)
         parser_x.set_defaults(func=Proxy)
 
+        parser_b = subparsers.add_parser('bench', aliases=['b'], help='benchmark the web server or the proxy')
+        parser_b.add_argument('target', choices=('web', 'proxy'), nargs='?', default='web',
+                              help='server started on loopback and benchmarked')
+        parser_b.add_argument('--clients', type=int, default=8,
+                              help='number of concurrent keep-alive clients')
+        parser_b.add_argument('--duration', type=float, default=5,
+                              help='seconds the load is kept up for')
+        parser_b.add_argument('--sizes', type=str, default='1024,16384,262144,1048576',
+                              help='comma separated sizes in bytes of the objects requested, picked at random')
+        addServerArguments(parser_b)
+        parser_b.add_argument('--cache-size', type=int, default=64 << 20,
+                              help='bytes of memory the server under test caches with')
+        parser_b.set_defaults(func=Benchmark, idle_timeout=5, max_requests=100, cache_file_limit=64 * 1024,
+                              max_object_size=1 << 20, default_ttl=300, disk_cache=None, disk_cache_size=1 << 30,
+                              pool_idle=4, pool_max=16, pool_idle_timeout=30)
+
+        for subparser in (parser_w, parser_x):
+            subparser.add_argument('--workers', type=int, default=1,
+                                   help='number of processes serving the port together through SO_REUSEPORT')
+
+        for subparser in (parser_p, parser_t, parser_w, parser_x, parser_b):
+            addOutputArguments(subparser)
+
         args = parser.parse_args()
         return args
 
 
+def addOutputArguments(parser):
+        #Structured output options shared by every application
+        parser.add_argument('--output', choices=OutputSink.FORMATS, default='text',
+                            help='also write one record per probe, hop or request as JSON Lines or CSV')
+        parser.add_argument('--output-file', type=str, default=None,
+                            help='file the records are written to (standard output by default, '
+                                 'the human readable text then goes to standard error)')
+
+
+def addServerArguments(parser):
+        #Concurrency options shared by the web server and the proxy
+        parser.add_argument('--mode', choices=ConnectionEngine.MODES, default='threads',
+                            help='how connections are served: serial, a bounded thread pool or a selector event loop')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='number of worker threads used in threads mode')
+        parser.add_argument('--backlog', type=int, default=128,
+                            help='listen backlog of the server socket')
+        parser.add_argument('--max-connections', type=int, default=64,
+                            help='maximum number of connections being served at once')
+        parser.add_argument('--metrics', action='store_true',
+                            help='collect metrics and serve them in Prometheus format on /__metrics')
+        parser.add_argument('--profile', action='store_true',
+                            help='run the sampling profiler from the start (/__profile?start and ?stop toggle it)')
+        parser.add_argument('--host', type=str, default=None,
+                            help='address to listen on (the machine\'s host name by default)')
+        parser.add_argument('--no-compression', action='store_true',
+                            help='never gzip or deflate responses, whatever the client accepts')
+        parser.add_argument('--compress-min-size', type=int, default=1024,
+                            help='smallest body in bytes worth compressing')
+        parser.add_argument('--compression-cache', type=int, default=32 << 20,
+                            help='bytes of memory used to keep compressed variants of hot objects')
+        parser.set_defaults(workers=1)
+
+
+def payloadSize(value):
+        #Type of --size, an echo payload has to fit in one IPv4 datagram next to the IP and ICMP headers
+        size = int(value)
+        if not 0 <= size <= 65507:
+            raise argparse.ArgumentTypeError('payload size must be from 0 to 65507 bytes, not %d' % size)
+        return size
+
+
+class Resolver:
+
+    # DNS resolver shared by every application. Forward (A) and reverse (PTR)
+    # answers are cached, failures too but for a shorter time, and lookups run on
+    # a small pool of background threads so callers can start many at once and
+    # only wait when they need the answer. Concurrent lookups of one name share a
+    # single query. Once more than maxEntries answers are cached, expired ones are
+    # dropped, then the oldest, so a long running proxy does not keep every host.
+    maxEntries = 4096
+
+    def __init__(self, ttl=300, negativeTtl=30, workers=8):
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.cache = {} #(kind, name) -> (expires, result, error), oldest first
+        self.pending = {} #(kind, name) -> Future of the lookup in progress
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def resolve(self, hostname):
+        return self.resolveAsync(hostname).result()
+
+    def resolveAsync(self, hostname):
+        return self.lookupAsync('A', hostname, socket.gethostbyname)
+
+    def reverseAsync(self, address):
+        return self.lookupAsync('PTR', address, self.hostnameOf)
+
+    def reverseBatch(self, addresses):
+        #Start the PTR lookups of every distinct address at once, returns address -> Future
+        return {address: self.reverseAsync(address) for address in set(addresses)}
+
+    def hostnameOf(self, address):
+        return socket.gethostbyaddr(address)[0]
+
+    def lookupAsync(self, kind, name, function):
+        key = (kind, name)
+        with self.lock:
+            # 1. Answer from the cache while the answer (or the failure) is still fresh
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self.hits += 1
+                future = Future()
+                if cached[2] is not None:
+                    future.set_exception(cached[2])
+                else:
+                    future.set_result(cached[1])
+                return future
+
+            # 2. Share a lookup already in progress, otherwise start one in the background
+            future = self.pending.get(key)
+            if future is None:
+                self.misses += 1
+                future = self.pool.submit(self.lookup, key, function, name)
+                self.pending[key] = future
+            return future
+
+    def lookup(self, key, function, name):
+        #Any failure is cached and raised as an OSError, which is what callers skip a bad name on. A malformed name
+        #fails in the IDNA codec with a UnicodeError instead
+        try:
+            result, error = function(name), None
+        except OSError as e:
+            result, error = None, e
+        except Exception as e:
+            result, error = None, socket.gaierror(str(e))
+
+        with self.lock:
+            ttl = self.ttl if error is None else self.negativeTtl
+            self.cache.pop(key, None)
+            self.cache[key] = (time.monotonic() + ttl, result, error)
+            self.pending.pop(key, None)
+            if len(self.cache) > self.maxEntries:
+                self.prune()
+
+        if error is not None:
+            raise error
+        return result
+
+    def prune(self):
+        #Called with the lock held. Drop the expired answers, then the oldest until a quarter of the room is free again
+        now = time.monotonic()
+        for key in [key for key, cached in self.cache.items() if cached[0] <= now]:
+            del self.cache[key]
+        while len(self.cache) > self.maxEntries * 3 // 4:
+            del self.cache[next(iter(self.cache))]
+
+    def stats(self):
+        return 'resolver: %d cache hits, %d lookups' % (self.hits, self.misses)
+
+
+class OutputSink:
+
+    # Structured output, one record per probe, hop, summary or HTTP request, as
+    # JSON Lines or CSV. emit only appends the record to a batch under a lock. A
+    # single background thread encodes and writes the batch once it is full, and
+    # whatever there is every flushInterval seconds even when no records follow,
+    # which keeps the records in order and off the probe and request loops. path is the file the stream writes to, None for standard output.
+    FORMATS = ('text', 'json', 'csv')
+    columns = ('record', 'time', 'host', 'address', 'ttl', 'bytes', 'rtt', 'method', 'path', 'status', 'cache',
+               'duration', 'sent', 'received', 'loss', 'min', 'avg', 'max', 'stddev', 'jitter', 'p50', 'p90', 'p99')
+
+    def __init__(self, stream, format='json', batchSize=256, flushInterval=1.0, path=None):
+        self.stream = stream
+        self.path = path
+        self.format = format
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.batch = []
+        self.headerWritten = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def emit(self, record, fields):
+        fields['record'] = record
+        fields['time'] = time.time()
+        with self.condition:
+            self.batch.append(fields)
+            if len(self.batch) >= self.batchSize:
+                self.condition.notify()
+
+    def run(self):
+        #Write the batch once it is full or flushInterval has passed, until the sink is closed
+        while True:
+            with self.condition:
+                if not self.closed and len(self.batch) < self.batchSize:
+                    self.condition.wait(self.flushInterval)
+                batch, self.batch = self.batch, []
+                closed = self.closed
+            if batch:
+                self.write(batch)
+            if closed:
+                return
+
+    def writeHeader(self):
+        #Called before forking workers which share standard output, so the CSV header is written there once
+        if self.format == 'csv' and self.path is None and not self.headerWritten:
+            self.stream.write(','.join(self.columns) + '\n')
+            self.stream.flush()
+            self.headerWritten = True
+
+    def forWorker(self, number):
+        #A sink of its own for a pre-forked worker, whose writer thread does not survive fork(). Records go to a file
+        #of the worker's own next to the shared one, as in that one they would interleave and every worker would write
+        #a CSV header. On standard output each batch is written whole behind the header the supervisor wrote
+        if self.path is None:
+            sink = OutputSink(self.stream, self.format, self.batchSize, self.flushInterval)
+            sink.headerWritten = self.headerWritten
+            return sink
+        path = '%s.worker-%d' % (self.path, number)
+        return OutputSink(open(path, 'w', newline=''), self.format, self.batchSize, self.flushInterval, path)
+
+    def write(self, batch):
+        if self.format == 'csv':
+            text = io.StringIO()
+            writer = csv.writer(text, lineterminator='\n')
+            if not self.headerWritten:
+                writer.writerow(self.columns)
+                self.headerWritten = True
+            writer.writerows([fields.get(column, '') for column in self.columns] for fields in batch)
+            text = text.getvalue()
+        else:
+            text = ''.join(json.dumps(fields) + '\n' for fields in batch)
+        self.stream.write(text)
+        self.stream.flush()
+
+    def close(self):
+        #Write out whatever is left and wait for the writer to finish
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+        if self.path is not None:
+            self.stream.close()
+
+
+class Metrics:
+
+    # Instrumentation of the servers: counters, gauges and per stage timers,
+    # rendered in the Prometheus text format on /__metrics. Timers are histograms
+    # of seconds labelled by stage. Gauges are either adjusted as things start and
+    # finish, or registered as functions read at scrape time, so caches and pools
+    # need no extra bookkeeping. Everything returns straight away while disabled.
+    prefix = 'netapp_'
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0) #upper bounds in seconds
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {} #name -> value
+        self.gauges = {} #name -> value
+        self.sources = {} #name -> (type, function returning the value)
+        self.timers = {} #stage -> count per bucket (the last one +Inf), then sum and count
+        self.lock = threading.Lock()
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0
+
+    def observe(self, stage, started):
+        #Time a stage from a start() taken when it began
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                timer = self.timers[stage] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            timer[bisect.bisect_left(self.buckets, elapsed)] += 1
+            timer[-2] += elapsed
+            timer[-1] += 1
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def adjust(self, name, amount):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + amount
+
+    def register(self, name, type, function):
+        self.sources[name] = (type, function)
+
+    def render(self):
+        with self.lock:
+            counters, gauges = dict(self.counters), dict(self.gauges)
+            timers = {stage: list(timer) for stage, timer in self.timers.items()}
+
+        samples = [(name, 'counter', value) for name, value in counters.items()]
+        samples += [(name, 'gauge', value) for name, value in gauges.items()]
+        samples += [(name, type, function()) for name, (type, function) in self.sources.items()]
+
+        lines = []
+        typed = set()
+        for name, type, value in sorted(samples):
+            family = name.split('{')[0]
+            if family not in typed:
+                lines.append('# TYPE %s%s %s' % (self.prefix, family, type))
+                typed.add(family)
+            lines.append('%s%s %s' % (self.prefix, name, value))
+
+        if timers:
+            lines.append('# TYPE %sstage_seconds histogram' % (self.prefix))
+        for stage, timer in sorted(timers.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), timer):
+                cumulative += count
+                lines.append('%sstage_seconds_bucket{stage="%s",le="%s"} %d' % (self.prefix, stage, bound, cumulative))
+            lines.append('%sstage_seconds_sum{stage="%s"} %f' % (self.prefix, stage, timer[-2]))
+            lines.append('%sstage_seconds_count{stage="%s"} %d' % (self.prefix, stage, timer[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class SamplingProfiler:
+
+    # Statistical wall clock profiler for the servers. While running, a background
+    # thread takes the stack of every other thread each interval seconds and counts
+    # every distinct stack, so it costs nothing until it is started. dump() lists the
+    # hottest stacks in the collapsed format flame graph tools read.
+    def __init__(self, interval=0.005, depth=40):
+        self.interval = interval
+        self.depth = depth
+        self.stacks = {} #collapsed stack -> number of samples
+        self.samples = 0
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock() #taken by dump() while it reads the counts being updated
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def sample(self):
+        own = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                    self.samples += 1
+            time.sleep(self.interval)
+
+    def dump(self, top=20):
+        with self.lock:
+            stacks, samples = dict(self.stacks), self.samples
+        hottest = heapq.nlargest(top, stacks.items(), key=lambda item: item[1])
+        lines = ['# %d samples, profiler %s' % (samples, 'running' if self.running else 'stopped')]
+        lines += ['%s %d' % (stack, count) for stack, count in hottest]
+        return '\n'.join(lines) + '\n'
+
+
 class NetworkApplication:
 
+    resolver = Resolver()
+    packetFactories = OrderedDict() #(ID, payload) -> EchoPacketFactory, least recently used first
+    maxPacketFactories = 64
+    output = None #OutputSink for structured records, None when only text is printed
+    metrics = Metrics() #disabled unless a server is started with --metrics
+    profiler = None
+
     def checksum(self, dataToChecksum: str) -> str:
-        csum = 0
+        # Sums the data as 16 bit little endian words in C through an array instead
+        # of a Python loop over every word, then folds and complements as before.
         countTo = (len(dataToChecksum) // 2) * 2
-        count = 0
-
-        while count < countTo:
-            thisVal = dataToChecksum[count+1] * 256 + dataToChecksum[count]
-            csum = csum + thisVal
-            csum = csum & 0xffffffff
-            count = count + 2
+        words = array.array('H', bytes(dataToChecksum[:countTo]))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        csum = sum(words)
 
         if countTo < len(dataToChecksum):
             csum = csum + dataToChecksum[len(dataToChecksum) - 1]
-            csum = csum & 0xffffffff
 
-        csum = (csum >> 16) + (csum & 0xffff)
-        csum = csum + (csum >> 16)
+        while csum >> 16:
+            csum = (csum >> 16) + (csum & 0xffff)
         answer = ~csum
         answer = answer & 0xffff
         answer = answer >> 8 | (answer << 8 & 0xff00)
@@ -77,7 +528,50 @@ class NetworkApplication:
 
         return answer
 
-    def printOneResult(self, destinationAddress: str, packetLength: int, time: float, ttl: int, destinationHostname=''):
+    def echoPacket(self, ID, sequence, payload=b''):
+        #Echo requests are built from a template per ID and payload, packed and checksummed only once
+        key = (ID, payload)
+        factory = self.packetFactories.get(key)
+        if factory is None:
+            factory = self.packetFactories[key] = EchoPacketFactory(self.checksum, ID, payload)
+            if len(self.packetFactories) > self.maxPacketFactories:
+                self.packetFactories.popitem(last=False)
+        else:
+            self.packetFactories.move_to_end(key)
+        return factory.packet(sequence)
+
+    def instrumentation(self, path):
+        #Body of the /__metrics and /__profile endpoints, None for any other path or while metrics are off
+        if not self.metrics.enabled:
+            return None
+        if path == '/__metrics':
+            return self.metrics.render()
+        if path.split('?')[0] == '/__profile':
+            action = path.partition('?')[2]
+            if action == 'start':
+                self.profiler.start()
+            elif action == 'stop':
+                self.profiler.stop()
+            return self.profiler.dump()
+        return None
+
+    def startInstrumentation(self, args):
+        self.metrics = Metrics(args.metrics)
+        self.profiler = SamplingProfiler()
+        if args.profile:
+            self.profiler.start()
+
+    def stopInstrumentation(self):
+        if self.profiler.samples:
+            self.profiler.stop()
+            print(self.profiler.dump())
+
+    def emit(self, record, **fields):
+        if self.output is not None:
+            self.output.emit(record, fields)
+
+    def printOneResult(self, destinationAddress: str, packetLength: int, time: float, ttl: int, destinationHostname='', record='probe'):
+        self.emit(record, host=destinationHostname, address=destinationAddress, bytes=packetLength, ttl=ttl, rtt=time)
         if destinationHostname:
             print("%d bytes from %s (%s): ttl=%d time=%.2f ms" % (packetLength, destinationHostname, destinationAddress, ttl, time))
         else:
@@ -88,146 +582,631 @@ class NetworkApplication:
         if minimumDelay > 0 and averageDelay > 0 and maximumDelay > 0:
             print("rtt min/avg/max = %.2f/%.2f/%.2f ms" % (minimumDelay, averageDelay, maximumDelay))
 
+    def printStatistics(self, stats, host=''):
+        if self.output is not None:
+            self.emit('summary', host=host, sent=stats.sent, received=stats.received, loss=stats.loss(),
+                      min=stats.minimum, avg=stats.mean, max=stats.maximum, stddev=stats.stddev(), jitter=stats.jitter,
+                      p50=stats.quantile(0.5), p90=stats.quantile(0.9), p99=stats.quantile(0.99))
+        print("%d packets transmitted, %d received" % (stats.sent, stats.received))
+        self.printAdditionalDetails(stats.loss(), stats.minimum, stats.mean, stats.maximum)
+        if stats.received:
+            print("rtt stddev = %.2f ms, jitter = %.2f ms" % (stats.stddev(), stats.jitter))
+            print("rtt p50/p90/p99 = %.2f/%.2f/%.2f ms" % (stats.quantile(0.5), stats.quantile(0.9), stats.quantile(0.99)))
+
+
+class ProbeClock:
+
+    # Timestamps for round trip times. Probes are timed with the monotonic
+    # perf_counter_ns clock, so wall clock jumps do not skew them. With kernel
+    # timestamps on, receive times come from SO_TIMESTAMPNS ancillary data set when
+    # the packet reached the socket, leaving out however long Python took to get to
+    # it. The kernel stamps with the wall clock, so sends are then stamped with
+    # time_ns too and those two are compared instead.
+    SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35) #35 on Linux, where Python does not export it
+    timespec = struct.Struct('ll')
+
+    def __init__(self, kernelTimestamps=False):
+        self.kernelTimestamps = kernelTimestamps
+
+    def enable(self, sock):
+        #Ask the kernel to stamp packets received on sock, falling back to user space timing where it cannot
+        if self.kernelTimestamps:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, self.SO_TIMESTAMPNS, 1)
+            except OSError as e:
+                print('Kernel timestamps unavailable (%s), timing in user space' % (e))
+                self.kernelTimestamps = False
+
+    def now(self):
+        return (time.perf_counter_ns(), time.time_ns() if self.kernelTimestamps else None)
+
+    def recvfrom(self, sock, size):
+        #Returns the packet, the sender's address and the time it was received
+        if not self.kernelTimestamps:
+            packet, addr = sock.recvfrom(size)
+            return packet, addr, (time.perf_counter_ns(), None)
+
+        packet, ancdata, flags, addr = sock.recvmsg(size, socket.CMSG_SPACE(self.timespec.size))
+        received = (time.perf_counter_ns(), None)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == self.SO_TIMESTAMPNS and len(data) >= self.timespec.size:
+                seconds, nanoseconds = self.timespec.unpack(data[:self.timespec.size])
+                received = (received[0], seconds * 1000000000 + nanoseconds)
+        return packet, addr, received
+
+    def elapsed(self, sent, received):
+        #Milliseconds between two stamps, on the kernel's clock when both ends have it
+        if sent[1] is not None and received[1] is not None:
+            return (received[1] - sent[1]) / 1e6
+        return (received[0] - sent[0]) / 1e6
+
+
+class RttStats:
+
+    # Round trip statistics kept in constant memory however long the run, so no
+    # samples are stored. Mean and standard deviation are updated with Welford's
+    # method. Jitter is the RFC 3550 estimate, smoothed over 1/16 of each change
+    # between consecutive round trips. Percentiles come from an HDR style histogram
+    # in microseconds: values below 64us are exact, and above that every power of two
+    # is split into 32 buckets. That keeps quantiles within about 3% and bounds the
+    # histogram to a couple of thousand buckets.
+    subBuckets = 32
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = 0.0
+        self.maximum = 0.0
+        self.jitter = 0.0
+        self.last = None
+        self.histogram = {} #bucket -> number of samples
+
+    def probe(self):
+        self.sent += 1
+
+    def add(self, rtt):
+        #Feed one round trip time in milliseconds
+        self.received += 1
+        if self.received == 1:
+            self.minimum = self.maximum = rtt
+        else:
+            self.minimum = min(self.minimum, rtt)
+            self.maximum = max(self.maximum, rtt)
+
+        delta = rtt - self.mean
+        self.mean += delta / self.received
+        self.m2 += delta * (rtt - self.mean)
+
+        if self.last is not None:
+            self.jitter += (abs(rtt - self.last) - self.jitter) / 16
+        self.last = rtt
+
+        bucket = self.bucket(max(0, int(rtt * 1000)))
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def bucket(self, micros):
+        if micros < 2 * self.subBuckets:
+            return micros
+        shift = micros.bit_length() - self.subBuckets.bit_length()
+        return shift * self.subBuckets + (micros >> shift)
+
+    def bucketValue(self, bucket):
+        #Middle of the range of microsecond values counted in a bucket
+        if bucket < 2 * self.subBuckets:
+            return bucket
+        shift = bucket // self.subBuckets - 1
+        return ((bucket % self.subBuckets + self.subBuckets) << shift) + (1 << shift) / 2
+
+    def stddev(self):
+        return (self.m2 / (self.received - 1)) ** 0.5 if self.received > 1 else 0.0
+
+    def loss(self):
+        return 100 - (self.received / self.sent) * 100 if self.sent else 0.0
+
+    def quantile(self, q):
+        #Round trip time in milliseconds below which a fraction q of the samples lie
+        rank = max(1, int(q * self.received + 0.999999))
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= rank:
+                return min(self.maximum, max(self.minimum, self.bucketValue(bucket) / 1000))
+        return self.maximum
+
+
+class EchoPacketFactory:
+
+    # Builds ICMP echo requests for one identifier and payload. The packet is
+    # checksummed once as a template with sequence number 0, after which each
+    # packet only needs its sequence number packed in and the checksum updated
+    # incrementally for that one changed word (RFC 1624, eqn. 3).
+    ICMP_ECHO_REQUEST = 8
+    header = struct.Struct("bbHHh")
+
+    def __init__(self, checksum, identifier, payload=b''):
+        self.identifier = identifier
+        self.payload = payload
+        self.templateSum = ~checksum(self.header.pack(self.ICMP_ECHO_REQUEST, 0, 0, identifier, 0) + payload) & 0xffff
+
+    def packet(self, sequence):
+        # 1. HC' = ~(~HC + ~m + m'), the changed word goes from m = 0 (so ~m adds nothing) to the new sequence number
+        csum = self.templateSum + (sequence & 0xffff)
+        csum = (csum >> 16) + (csum & 0xffff)
+
+        # 2. Pack the header with the updated checksum in front of the payload
+        return self.header.pack(self.ICMP_ECHO_REQUEST, 0, ~csum & 0xffff, self.identifier, sequence) + self.payload
+
+
+class TimerWheel:
+
+    # Hashed timing wheel for probe timeouts. Time is cut into ticks and a timer
+    # goes into the slot of the tick it expires in, modulo the number of slots, so
+    # scheduling and cancelling are a dict insert and delete however many timers
+    # are running. Advancing only visits the slots of the ticks which passed, where
+    # timers due on a later turn of the wheel are just passed over.
+    def __init__(self, tick=0.01, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)] #key -> tick it expires in
+        self.where = {} #key -> its slot
+        self.current = int(time.monotonic() / tick) #last tick advanced to
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay):
+        due = int((time.monotonic() + delay) / self.tick) + 1
+        self.cancel(key)
+        slot = self.slots[due % len(self.slots)]
+        slot[key] = due
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self):
+        #Returns the keys of the timers which expired since the last call
+        expired = []
+        now = int(time.monotonic() / self.tick)
+        #A full turn of the wheel visits every slot, however long it has been
+        for tick in range(max(self.current + 1, now - len(self.slots) + 1), now + 1):
+            slot = self.slots[tick % len(self.slots)]
+            for key in [key for key, due in slot.items() if due <= now]:
+                del slot[key]
+                del self.where[key]
+                expired.append(key)
+        self.current = now
+        return expired
+
+
+class ProbeCore:
+
+    # Event loop driven probing, shared by ping and traceroute. The raw socket
+    # replies come in on is registered with asyncio, outstanding probes are kept
+    # in a dict keyed by (ID, sequence) and a timer wheel expires the ones left
+    # unanswered. Waiting for a reply never blocks the process, so any number of
+    # probes can be in flight at once, and each reply or timeout costs the same
+    # however many there are.
+    receiveBuffer = 4 << 20 #room for replies to thousands of probes sent in one burst
+
+    def __init__(self, clock, receiveSocket, match, receiveSize=65535, tick=0.01):
+        self.clock = clock
+        self.receiveSocket = receiveSocket
+        self.match = match #reply packet -> (ID, sequence) of the probe it answers, None if not one of ours
+        self.receiveSize = receiveSize
+        self.wheel = TimerWheel(tick)
+        self.outstanding = {} #(ID, sequence) -> (future, send stamp)
+        self.ticker = None
+        self.loop = None
+
+    def run(self, main):
+        #Runs the coroutine main on a new event loop, with replies being read for as long as it runs
+        async def probing():
+            self.start()
+            try:
+                return await main
+            finally:
+                self.stop()
+        return asyncio.run(probing())
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.receiveSocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBuffer)
+        except OSError:
+            pass #the default buffer only drops replies under heavy load
+        self.receiveSocket.setblocking(False)
+        self.loop.add_reader(self.receiveSocket, self.readable)
+
+    def stop(self):
+        self.loop.remove_reader(self.receiveSocket)
+        if self.ticker is not None:
+            self.ticker.cancel()
+            self.ticker = None
+        for key in list(self.outstanding):
+            self.settle(key, None)
+
+    def send(self, sendSocket, packet, address, key, timeout):
+        #Sends a probe, returning a future for its (reply, sender, round trip time), or None once timeout passes
+        if key in self.outstanding:
+            self.settle(key, None) #its sequence number came round again before a reply did
+        future = self.loop.create_future()
+
+        # 1. Stamp the probe just before it leaves, so the reply can never beat it
+        self.outstanding[key] = (future, self.clock.now())
+        try:
+            sendSocket.sendto(packet, address)
+        except OSError:
+            del self.outstanding[key]
+            raise
+
+        # 2. Set its timeout, turning the wheel for as long as any probe is waiting
+        self.wheel.schedule(key, timeout)
+        if self.ticker is None:
+            self.ticker = self.loop.call_later(self.wheel.tick, self.turn)
+        return future
+
+    def turn(self):
+        self.ticker = None
+        for key in self.wheel.advance():
+            self.settle(key, None)
+        if self.outstanding:
+            self.ticker = self.loop.call_later(self.wheel.tick, self.turn)
+
+    def readable(self):
+        #Match every reply waiting on the socket to its probe
+        while True:
+            try:
+                recPacket, addr, received = self.clock.recvfrom(self.receiveSocket, self.receiveSize)
+            except (BlockingIOError, InterruptedError):
+                return
+            key = self.match(recPacket)
+            entry = self.outstanding.get(key)
+            if entry is not None:
+                self.settle(key, (recPacket, addr, self.clock.elapsed(entry[1], received)))
+
+    def settle(self, key, result):
+        future, sendTime = self.outstanding.pop(key)
+        self.wheel.cancel(key)
+        if not future.done():
+            future.set_result(result)
+
 
 class ICMPPing(NetworkApplication):
 
-    sendTime = 0
     sequence = 1
     ICMP_ECHO_REQUEST = 8
+    ICMP_ECHO_REPLY = 0
+    ICMP_UNREACHABLE = 3
+    FRAGMENTATION_NEEDED = 4
     Destination = 999
+    icmpSocket = None
+    payload = b''
+    receiveSize = 65535 #large enough for any reply, whatever the payload
+    IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10) #Linux values, Python does not export them
+    IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+    IP_MTU = getattr(socket, 'IP_MTU', 14)
+    headerSize = 28 #IP and ICMP echo headers in front of the payload
+    pmtuTtl = 600 #seconds a measured path MTU is trusted, as long as the kernel keeps learned ones
+    pmtuCache = {} #address -> (expires, path MTU)
 
 
-    def packet(self,ID):
-        # 1. Build ICMP header
-        header = struct.pack("bbHHh", self.ICMP_ECHO_REQUEST, 0, 0, ID, self.sequence)
-        
-        # 2. Checksum ICMP packet using given function
-        checksum = super().checksum(header)
-        
-        # 3. Insert checksum into packet by re-packing & return the packet
-        header = struct.pack("bbHHh", self.ICMP_ECHO_REQUEST, 0, checksum, ID, self.sequence)
-        return header
+    def packet(self,ID,sequence=None):
+        if sequence is None:
+            sequence = self.sequence
 
-    def sendOnePing(self, icmpSocket, destinationAddress, ID):
-        # 0. Create packet
-        packet = self.packet(ID)
-        
-        # 1. Send packet using socket
-        icmpSocket.sendto(packet,(destinationAddress,1))
-        
-        # 2. Record time of sending
-        self.sendTime = time.time()
+        # 1. Build ICMP header from the template for this ID, only the sequence number and checksum change
+        return self.echoPacket(ID, sequence, self.payload)
 
+    def payloadOf(self, size):
+        #Payload of the given number of bytes, a repeating byte count like ping's
+        return bytes(range(256)) * (size // 256) + bytes(range(size % 256))
 
-    def receiveOnePing(self, icmpSocket, destinationAddress, timeout, ID):
-        # 1. Wait for the socket to receive a reply
-        startTime = time.time()
-        while startTime+timeout > time.time():
-            
-            try:
-                recPacket, addr = icmpSocket.recvfrom(1024)
-                #packetTemp = icmpSocket.recv(4096)
-            except socket.timeout:
-                break
+    def sendOnePing(self, icmpSocket, destinationAddress, ID):
+        # 0. Create packet, numbered so its reply can be told apart from the others arriving on the socket
+        packet = self.packet(self.identifier, ID)
 
-            # 2. Once received, record time of receipt, otherwise, handle a timeout
-            receivedTime = time.time()
+        # 1. Send packet through the probing core, which records the time of sending against (ID, sequence)
+        return self.core.send(icmpSocket, packet, (destinationAddress, 1), (self.identifier, ID), self.timeout)
 
-            # 3. Compare the time of receipt to time of sending, producing the total network delay
-            timeComp = receivedTime - self.sendTime
-            timeComp *= 1000
+    async def receiveOnePing(self, reply):
+        # 1. Wait for the reply to this probe without holding up any other, the core gives up on it at the timeout
+        result = await reply
+        if result is None:
+            return (0, 0, 0, 0, 0)
 
-            # 4. Unpack the packet header for useful information, including the ID
-            icmp_header = recPacket[20:28]
-            size = sys.getsizeof(recPacket) 
-            ttl = recPacket[8]
-            
-            type, code, checksum, packetID, sequence = struct.unpack('bbHHh', icmp_header)
-            
-            # 5. Check that the ID matches between the request and reply
-            # 6. Return total network delay
-            if(packetID == ID):
-                
-                return (timeComp,addr,self.Destination,size, ttl)
-            else:
-                
-                return (0, 0, 0, 0, 0)
+        # 2. Once received, the core has compared the time of receipt to the time of sending
+        recPacket, addr, timeComp = result
 
-    def doOnePing(self, destinationAddress, timeout, ID, dataDoOne):
+        # 3. Unpack the packet header for useful information, the size is that of the ICMP message like ping's
+        ihl = (recPacket[0] & 0x0f) * 4
+        size = len(recPacket) - ihl
+        ttl = recPacket[8]
 
-        # 1. Create ICMP socket, setting the ttl and timeout
-        ICMP_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW,socket.getprotobyname("icmp"))
-        #ICMP_socket.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl) #set ttl
-        ICMP_socket.settimeout(timeout)
-        packet_id = ID
+        # 4. Return total network delay
+        return (timeComp, addr, self.Destination, size, ttl)
 
-        # 2. Call sendOnePing function
-        self.sendOnePing(ICMP_socket, destinationAddress, packet_id)
+    async def doOnePing(self, destinationAddress, ID):
+        # 1. Call sendOnePing function
+        reply = self.sendOnePing(self.icmpSocket, destinationAddress, ID)
 
         # 2. Call receiveOnePing function
-        timeComparison, address, dest, size, ttl = self.receiveOnePing(ICMP_socket,destinationAddress,timeout, ID)
+        timeComparison, address, dest, size, ttl = await self.receiveOnePing(reply)
 
-        # 3. Close the socket and return the delay
-        ICMP_socket.close()
+        # 3. Return the delay
         return timeComparison, address, dest, size, ttl
 
-    def __init__(self, args):
-        print('Ping to: %s...' % (args.hostname))
+    def replyKey(self, recPacket):
+        #(ID, sequence) of the echo request a packet replies to, None for any other ICMP message
+        ihl = (recPacket[0] & 0x0f) * 4
+        type, code, checksum, packetID, sequence = struct.unpack('bbHHh', recPacket[ihl:ihl + 8])
+        if type == self.ICMP_ECHO_REPLY:
+            return (packetID, sequence)
+        return None
+
+    def openSocket(self):
+        #One raw socket carries every probe of the run, with the core matching replies to them
+        self.icmpSocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        self.clock.enable(self.icmpSocket)
+        self.identifier = os.getpid() & 0xffff
+        self.core = ProbeCore(self.clock, self.icmpSocket, self.replyKey, self.receiveSize)
+
+    def pathMtu(self, address, timeout):
+        # Largest IP packet which reaches address without being fragmented, found
+        # by binary search over echo requests with the DF bit set. Oversized probes
+        # fail locally with EMSGSIZE once the kernel knows the route's MTU (from the
+        # interface or a router's fragmentation needed message), and that MTU then
+        # caps the search. Returns the MTU (None if nothing gets through) and the
+        # number of probes sent. Answers are cached per destination.
+        cached = self.pmtuCache.get(address)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1], 0
+
+        sweepSocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        try:
+            sweepSocket.setsockopt(socket.IPPROTO_IP, self.IP_MTU_DISCOVER, self.IP_PMTUDISC_DO)
+            sweepSocket.connect((address, 1))
+            identifier = os.getpid() & 0xffff
+            low, high, probes = self.headerSize, 65535, 0
+
+            # 1. The smallest packet has to get through, otherwise the destination is not answering at all
+            probes += 1
+            if not self.probeSize(sweepSocket, identifier, probes, low, timeout):
+                return None, probes
+
+            # 2. Halve the range between the largest size known to pass and the smallest known to fail
+            while low < high:
+                size = (low + high + 1) // 2
+                probes += 1
+                if self.probeSize(sweepSocket, identifier, probes, size, timeout):
+                    low = size
+                else:
+                    try:
+                        high = min(size - 1, max(low, sweepSocket.getsockopt(socket.IPPROTO_IP, self.IP_MTU)))
+                    except OSError:
+                        high = size - 1
+        finally:
+            sweepSocket.close()
+
+        self.pmtuCache[address] = (time.monotonic() + self.pmtuTtl, low)
+        return low, probes
+
+    def probeSize(self, sweepSocket, identifier, sequence, size, timeout):
+        #Whether an echo request making an IP packet of size bytes is answered. Each probe size is sent once, so its
+        #packet is built directly rather than through the shared factories
+        packet = EchoPacketFactory(self.checksum, identifier, self.payloadOf(size - self.headerSize)).packet(sequence)
+        try:
+            sweepSocket.send(packet)
+        except OSError:
+            return False #EMSGSIZE, larger than the path MTU the kernel knows of
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([sweepSocket], [], [], remaining)[0]:
+                return False
+            try:
+                recPacket = sweepSocket.recv(self.receiveSize)
+            except OSError:
+                return False #a fragmentation needed message reported back on the socket
+            ihl = (recPacket[0] & 0x0f) * 4
+            type, code, checksum, packetID, replySequence = struct.unpack('bbHHh', recPacket[ihl:ihl + 8])
+            if type == self.ICMP_ECHO_REPLY and packetID == identifier and replySequence == sequence:
+                return True
+            if type == self.ICMP_UNREACHABLE and code == self.FRAGMENTATION_NEEDED:
+                return False
+
+    def sweep(self, hostnames, timeout):
+        for hostname in hostnames:
+            try:
+                address = self.resolver.resolve(hostname)
+            except OSError as e:
+                print('%s: %s' % (hostname, e))
+                continue
+            mtu, probes = self.pathMtu(address, timeout)
+            self.emit('pmtu', host=hostname, address=address, bytes=mtu)
+            if mtu is None:
+                print('%s (%s): no reply' % (hostname, address))
+            else:
+                print('%s (%s): path MTU %d bytes, largest payload %d bytes (%s)' % (
+                    hostname, address, mtu, mtu - self.headerSize, '%d probes' % probes if probes else 'cached'))
+
+    async def batchPing(self, hostnames, count, interval, maxRate, reportInterval=0):
+        # Pings every target at once over the one raw socket. Each target is probed
+        # every interval seconds, optionally capped to maxRate probes per second
+        # overall, and replies are matched back to their target through the ID and
+        # a sequence number unique across all outstanding probes.
+
+        # 1. Resolve every target concurrently, dropping (and reporting) those which do not resolve
+        lookups = [(hostname, asyncio.wrap_future(self.resolver.resolveAsync(hostname))) for hostname in hostnames]
+        targets = []
+        for hostname, lookup in lookups:
+            try:
+                address = await lookup
+            except OSError as e:
+                print('%s: %s' % (hostname, e))
+                continue
+            targets.append({'hostname': hostname, 'address': address, 'sent': 0, 'stats': RttStats()})
+
+        # 2. Report the statistics so far every reportInterval seconds while the targets are pinged
+        self.tokens, self.lastRefill = maxRate, time.monotonic()
+        reporter = asyncio.ensure_future(self.reportEvery(targets, reportInterval)) if reportInterval else None
+        try:
+            await asyncio.gather(*[self.pingTarget(target, count, interval, maxRate) for target in targets])
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+        # 3. Report loss and round trip times per target
+        self.printBatchStatistics(targets)
+
+    async def pingTarget(self, target, count, interval, maxRate):
+        #Probes one target every interval seconds, without waiting for the replies in between
+        replies = []
+        while target['sent'] < count:
+            await self.throttle(maxRate)
+            self.lastSequence = (self.lastSequence + 1) % 32768
+            reply = self.sendOnePing(self.icmpSocket, target['address'], self.lastSequence)
+            reply.add_done_callback(lambda reply: self.batchReply(target, reply.result()))
+            replies.append(reply)
+            target['sent'] += 1
+            target['stats'].probe()
+            if target['sent'] < count:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*replies)
+
+    def batchReply(self, target, result):
+        if result is None:
+            return
+        recPacket, addr, delay = result
+        ihl = (recPacket[0] & 0x0f) * 4
+        target['stats'].add(delay)
+        self.printOneResult(addr[0], len(recPacket) - ihl, delay, recPacket[8], target['hostname'])
+
+    async def throttle(self, maxRate):
+        #Token bucket shared by every target, refilled at maxRate probes per second
+        while maxRate > 0:
+            now = time.monotonic()
+            self.tokens = min(maxRate, self.tokens + (now - self.lastRefill) * maxRate)
+            self.lastRefill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / maxRate)
+
+    async def reportEvery(self, targets, reportInterval):
+        while True:
+            await asyncio.sleep(reportInterval)
+            self.printBatchStatistics(targets)
+
+    def printBatchStatistics(self, targets):
+        for target in targets:
+            print('--- %s (%s) ping statistics ---' % (target['hostname'], target['address']))
+            self.printStatistics(target['stats'], target['hostname'])
+
+    async def sequentialPing(self, hostname, count, reportInterval):
         i = 0
-        while i < 5:
-            # 1. Look up hostname, resolving it to an IP address
-            address = socket.gethostbyname(args.hostname)
+        nextReport = time.monotonic() + reportInterval
+        while i < count:
+            # 1. Look up hostname, resolving it to an IP address (cached after the first time)
+            address = self.resolver.resolve(hostname)
             # 2. Call doOnePing function, approximately every second
-            timeDif, address, dest, packSize, ttl = self.doOnePing(address, 5, i, "hiya")
+            timeDif, address, dest, packSize, ttl = await self.doOnePing(address, i % 32768)
+            self.stats.probe()
             # 3. Print out the returned delay (and other relevant details) using the printOneResult method
-            self.printOneResult(address, packSize, timeDif, ttl)
-            # 4. Continue this process until stopped
+            if address:
+                self.stats.add(timeDif)
+                self.printOneResult(address[0], packSize, timeDif, ttl, hostname)
+            else:
+                self.emit('probe', host=hostname, rtt=None)
+                print("TIMEOUT OCCURED - PACKET LOST")
+            # 4. Report the statistics so far every report interval, and continue this process until stopped
+            if reportInterval and time.monotonic() >= nextReport:
+                self.printStatistics(self.stats, hostname)
+                nextReport = time.monotonic() + reportInterval
             i += 1
 
+    def __init__(self, args):
+        count = args.count or 5
+        self.timeout = args.timeout or 5
+        self.clock = ProbeClock(args.kernel_timestamps)
+        self.payload = self.payloadOf(args.size)
+        self.lastSequence = 0
+
+        #Several targets are pinged concurrently instead
+        hostnames = [args.hostname] + (args.targets or [])
+        if args.targets_file:
+            with open(args.targets_file) as f:
+                hostnames += [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+        #Measure the path MTU to every target instead of pinging them
+        if args.pmtu:
+            print('Path MTU discovery to: %d targets...' % (len(hostnames)))
+            self.sweep(hostnames, args.timeout or 1)
+            return
+
+        self.openSocket()
+        if len(hostnames) > 1:
+            print('Ping to: %d targets...' % (len(hostnames)))
+            try:
+                self.core.run(self.batchPing(hostnames, count, args.interval, args.max_rate, args.report_interval))
+            except KeyboardInterrupt:
+                pass
+            finally:
+                self.icmpSocket.close()
+            return
+
+        print('Ping to: %s...' % (args.hostname))
+        self.stats = RttStats()
+        try:
+            self.core.run(self.sequentialPing(args.hostname, count, args.report_interval))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # 5. Close the socket once the run is over
+            self.icmpSocket.close()
+
+        print('--- %s ping statistics ---' % (args.hostname))
+        self.printStatistics(self.stats, args.hostname)
+
 
 class Traceroute(NetworkApplication):
 
     sequence = 1
     ICMP_ECHO_REQUEST = 8  
     UDP_REQUEST = socket.IPPROTO_UDP
-    SendingTime = 0
-    ReceiveTime = 0
     TimeComparisonVal = 0
     receivedPacketNum = 0
     expectedPacketNum = 0
     Destination = 999
     timeout = 0
     socketType = ''
+    ptrTimeout = 0.5 #longest a hop's output waits for its reverse lookups
+    probesPerHop = 3
+    udpBasePort = 33434 #UDP probes go to udpBasePort + probe number
 
 
-    def receiveOnePing(self, socket1, timeout):
+    async def receiveOnePing(self, reply):
         
-        # 1. Wait for the socket to receive a reply
-        startTime = time.time()
-            
-        try:
-
-            recPacket, addr = socket1.recvfrom(1024)
-
-        except Exception as e:
-            
-            socket1.close()
+        # 1. Wait for the reply to this probe without holding up any other, the core gives up on it at the timeout
+        result = await reply
+        if result is None:
             return None
 
-        # 2. Once received, record time of receipt, otherwise, handle a timeout
-        self.ReceiveTime = time.time()
+        # 2. Once received, the core has compared the time of receipt to the time of sending
+        recPacket, addr, self.TimeComparisonVal = result
 
-        # 3. Compare the time of receipt to time of sending, producing the total network delay
-        self.TimeComparisonVal = (self.ReceiveTime - self.SendingTime)*1000
-
-        # 4. Unpack the packet header for useful information, including the ID
-        header = recPacket[20:28]
-        size = sys.getsizeof(recPacket) - 19
+        # 3. Unpack the packet header for useful information
+        ihl = (recPacket[0] & 0x0f) * 4
+        header = recPacket[ihl:ihl + 8]
+        size = len(recPacket)
         
         messagetype, code, checksum, p_id, sequence = struct.unpack('bbHHh', header)
         
-        # 5. Check that the ID matches between the request and reply
-        # 6. Return total network delay
+        # 4. Return total network delay
         if(messagetype == 11 and code == 0): #type of ICMP response 
             
             self.receivedPacketNum += 1
@@ -250,93 +1229,147 @@ class Traceroute(NetworkApplication):
 
     def sendOnePing(self, socket, destinationAddress, ID):
         
-        # 0. Create packet
-        packet = self.packet(ID)
-            
-        # 0.1. Attempt to flush out any existing data before closing (only done if a timeout is very very low)
-        if(self.timeout < 0.5):
-            
-            try:
-                recv, recv2 = socket.recvfrom(1024)
-            except Exception as e:
-
-                pass
+        # 0. Create packet, numbered so the reply can be matched back to it
+        packet = self.packet(self.identifier, ID)
 
-            # Second attempt at receiving in case the first one timed out  
-            try:
-                recv, recv2 = socket.recvfrom(1024)
-            except Exception as e:
-                
-                pass
-
-        # 1. Send packet using socket
+        # 1. Send packet through the probing core, which records the time of sending against the probe
         if(self.socketType == 'icmp'):
             
-            socket.sendto(packet,(destinationAddress,1))
+            address = (destinationAddress,1)
 
         elif(self.socketType == 'udp'):
             
-            socket.sendto(packet,(destinationAddress,34000))
-        
-        # 2. Record time of sending
-        self.SendingTime = time.time()
+            address = (destinationAddress,self.udpBasePort + ID)
+
+        return self.core.send(socket, packet, address, (self.identifier, ID), self.timeout)
 
 
-    def packet(self,ID): #constructor for packet
+    def packet(self,ID,sequence=None): #constructor for packet
+        if sequence is None:
+            sequence = self.sequence
                 
-        # 1. Build ICMP header
-        header = struct.pack("bbHHh", self.ICMP_ECHO_REQUEST, 0, 0, ID, self.sequence)
-        
-        # 2. Checksum ICMP packet using given function
-        checksum = self.checksum(header)
-        
-        # 3. Insert checksum into packet by re-packing & return the packet
-        header = struct.pack("bbHHh", self.ICMP_ECHO_REQUEST, 0, checksum, ID, self.sequence)
+        # 1. Build ICMP header from the template for this ID, only the sequence number and checksum change
+        header = self.echoPacket(ID, sequence)
 
         self.expectedPacketNum += 1
         
         return header
 
 
-    def doOnePing(self, destinationAddress, timeout, ttl, ID, socketType):
+    def printHop(self, ttl, replies):
+        #Print the hop, waiting at most ptrTimeout for its hostnames to come back
+        hostnames = self.resolver.reverseBatch([reply[0] for reply in replies if reply])
+        deadline = time.monotonic() + self.ptrTimeout
+        for reply in replies:
+            if reply:
+                try:
+                    hostname = hostnames[reply[0]].result(max(0, deadline - time.monotonic()))
+                except Exception:
+                    #If host name is not resolved (yet) print the address instead of the hostname
+                    hostname = reply[0]
+                self.printOneResult(reply[0],reply[1],reply[2],ttl,hostname,'hop')
+            else:
+                self.emit('hop', ttl=ttl, rtt=None)
+                print("TIMEOUT OCCURED - PACKET LOST")
+
+        print("-------------------------------------------------------------------------------------------")
+
+    async def parallelTrace(self, addressIP, maxHops):
+        # Sends the probes of every TTL up to maxHops at once and matches replies to
+        # probes through the ICMP sequence number (or UDP destination port) quoted
+        # back in them, so the whole path takes about one timeout.
+        probes = {} #ttl -> replies to its probes
+
+        # 1. Send every probe, numbering them so the replies can be told apart
+        for ttl in range(1, maxHops + 1):
+            self.sendSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+            probes[ttl] = [self.sendOnePing(self.sendSocket, addressIP, (ttl - 1) * self.probesPerHop + j)
+                           for j in range(self.probesPerHop)]
+
+        # 2. Collect replies until every probe is answered or has timed out
+        results = {}
+        for ttl, replies in probes.items():
+            results[ttl] = []
+            for recPacket in await asyncio.gather(*replies):
+                results[ttl].append((recPacket[1][0], len(recPacket[0]), recPacket[2]) if recPacket else None)
+
+        # 3. Report hop by hop up to the first one answered by the destination itself
+        stats = RttStats()
+        for ttl in range(1, maxHops + 1):
+            replies = results[ttl]
+            for reply in replies:
+                stats.probe()
+                if reply:
+                    stats.add(reply[2])
+            self.printHop(ttl, replies)
+
+            if any(reply and reply[0] == addressIP for reply in replies):
+                print(f"{ttl} hops completed")
+                self.printStatistics(stats, addressIP)
+                return
+
+        print('MAX NUMBER OF HOPS REACHED')
+
+    def matchProbe(self, recPacket, identifier):
+        #Returns the number of the probe a reply answers, or None if it is not one of ours
+        ihl = (recPacket[0] & 0x0f) * 4
+        messagetype = recPacket[ihl]
+
+        #Echo reply from the destination, the ICMP header is our own
+        if messagetype == 0 and self.socketType != 'udp':
+            messagetype, code, checksum, p_id, sequence = struct.unpack('bbHHh', recPacket[ihl:ihl + 8])
+            return sequence if p_id == identifier else None
+
+        #Time exceeded or destination unreachable, quoting the IP header and first 8 bytes of our probe
+        if messagetype in (3, 11) and len(recPacket) >= ihl + 8 + 20:
+            quoted = ihl + 8
+            quotedIhl = (recPacket[quoted] & 0x0f) * 4
+            protocol = recPacket[quoted + 9]
+            original = recPacket[quoted + quotedIhl:quoted + quotedIhl + 8]
+            if len(original) < 8:
+                return None
+
+            if protocol == socket.IPPROTO_UDP and self.socketType == 'udp':
+                port = struct.unpack('!H', original[2:4])[0]
+                return port - self.udpBasePort
+            if protocol == socket.IPPROTO_ICMP and self.socketType != 'udp':
+                messagetype, code, checksum, p_id, sequence = struct.unpack('bbHHh', original)
+                return sequence if p_id == identifier else None
+        return None
+
+    def replyKey(self, recPacket):
+        #(ID, probe number) of the probe a reply answers, None if it is not one of ours
+        number = self.matchProbe(recPacket, self.identifier)
+        return None if number is None else (self.identifier, number)
+
+    def openSockets(self):
+        # 1. One raw ICMP socket receives every reply of the run, and sends the probes too in ICMP mode
+        self.receiveSocket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.getprotobyname("icmp"))
+        self.clock.enable(self.receiveSocket)
+        self.sendSocket = self.receiveSocket
+
+        # 2. In UDP mode the probes leave through one DGRAM socket instead
+        if self.socketType == 'udp':
+            self.sendSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.getprotobyname("udp"))
+
+        self.identifier = os.getpid() & 0xffff
+        self.core = ProbeCore(self.clock, self.receiveSocket, self.replyKey)
+
+    def closeSockets(self):
+        self.receiveSocket.close()
+        if self.sendSocket is not self.receiveSocket:
+            self.sendSocket.close()
+
+    async def doOnePing(self, destinationAddress, ttl, ID):
         
-       
-        # 1. Create ICMP socket, setting the ttl and timeout
-        #If the protocol type is ICMP create one ICMP socket and set the timeout using the correct methods
-        if socketType == 'icmp':
-
-            s = socket.socket(socket.AF_INET, socket.SOCK_RAW,socket.getprotobyname("icmp"))
-            s.setsockopt(socket.SOL_IP, socket.IP_TTL, ttl) #set TTL of socket
-            s.settimeout(self.timeout)
-
-        #If the protocol type is UDP 2 sockets are needed, one DGRAM socket and one RAW socket    
-        else:
-            
-            #receiving socket 
-            s = socket.socket(socket.AF_INET, socket.SOCK_RAW,socket.getprotobyname("icmp"))
-            s.settimeout(self.timeout)
-            
-            #sending socket
-            s2 = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,socket.getprotobyname("udp"))
-            s2.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl) #set TTL of socket
+        # 1. Set the TTL of the long lived sending socket for this probe
+        self.sendSocket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
 
-        tempID = ID
-
-        # 2. Call sendOnePing function passing a sending socket depending on protocol
-        if socketType == 'icmp':
-            
-            self.sendOnePing(s, destinationAddress, tempID)
-        else:
-            
-            self.sendOnePing(s2, destinationAddress, tempID)
-
-        # 3. Call receiveOnePing function, always receive on socket s
-        returnVal = self.receiveOnePing(s,self.timeout)
-
-        # 4. Close the socket and return the delay & extra info from reciveOnePing
-        s.close()
+        # 2. Call sendOnePing function
+        reply = self.sendOnePing(self.sendSocket, destinationAddress, ID)
 
-        return returnVal           
+        # 3. Call receiveOnePing function, replies always arrive on the ICMP socket
+        return await self.receiveOnePing(reply)
     
     def __init__(self, args):
         
@@ -351,11 +1384,12 @@ class Traceroute(NetworkApplication):
         
         self.timeout = args.timeout
         self.socketType = args.protocol
+        self.clock = ProbeClock(args.kernel_timestamps)
 
         #If the hostname is an unresolvable address, terminate the program after printing the error which occured
         try:
             
-            addressIP = socket.gethostbyname(args.hostname)
+            addressIP = self.resolver.resolve(args.hostname)
         except Exception as e:
             print(e)
             print("TERMINATING PROGRAM")
@@ -365,62 +1399,54 @@ class Traceroute(NetworkApplication):
         self.receivedPacketNum = 0
         self.expectedPacketNum = 0
 
+        #Every probe of the run goes through the same sockets
+        self.openSockets()
+        try:
+            if args.parallel:
+                self.core.run(self.parallelTrace(addressIP, args.max_hops))
+            else:
+                self.core.run(self.sequentialTrace(addressIP, args.max_hops))
+        finally:
+            self.closeSockets()
+
+    async def sequentialTrace(self, addressIP, maxHops):
+
         ttl = 1
         ID = 1
-        lowestTime = 0
-        highestTime = 0
-        avgTime = 0
-        sumTime = 0
+        stats = RttStats()
         temp = None
 
-        while ttl < 31: #max num of hops is 30
+        while ttl <= maxHops: #max num of hops is 30 by default
             
             #Perform the ping operation 3 times on each ttl
             j = 0
+            replies = []
             while j < 3:
 
                 #Attempt to receive a response, if you dont a timeout occured 
-                resp = self.doOnePing(addressIP,self.timeout,ttl, ID, self.socketType)
+                resp = await self.doOnePing(addressIP, ttl, ID)
+                stats.probe()
                 if resp:
                     
                     #Unpack contents of resp into specific variables
                     delay,addr,info,size = resp 
+                    stats.add(delay)
 
-                    if lowestTime == 0 and highestTime == 0:
-                        
-                        lowestTime = delay
-                        highestTime = delay
-
-                    elif lowestTime != 0 and highestTime != 0:
-                        
-                        if delay < lowestTime:
-                            lowestTime = delay
-                        elif delay > highestTime:
-                            highestTime = delay
-                        
-                    sumTime += delay
-
-                    try:
-                        
-                        hostname = socket.gethostbyaddr(addr[0]) 
-                        self.printOneResult(addr[0],size,delay,ttl,hostname[0])
-                    except:
-                        
-                        hostname = None
-                        #If host name is not resolved print the address instead of the hostname
-                        self.printOneResult(addr[0],size,delay,ttl,addr[0])
+                    #Start resolving the hop's hostname in the background while the remaining probes go out
+                    self.resolver.reverseAsync(addr[0])
+                    replies.append((addr[0], size, delay))
 
                 else:
                     
-                    print("TIMEOUT OCCURED - PACKET LOST")
+                    replies.append(None)
 
                 j += 1
                 ID += 1
 
-            print("-------------------------------------------------------------------------------------------")
+            self.printHop(ttl, replies)
 
             #Check if current address is the final address    
-            if addr[0] != addressIP:
+            if not any(reply and reply[0] == addressIP for reply in replies):
                 ttl += 1
             else:
                 temp = ttl
@@ -429,195 +1455,2358 @@ class Traceroute(NetworkApplication):
         
         if temp != None:
             
-            avgTime = sumTime/(temp*3)
-            packLoss = 100 - ((self.receivedPacketNum / self.expectedPacketNum) * 100)
-            self.printAdditionalDetails(packLoss, lowestTime, avgTime, highestTime)
+            self.printStatistics(stats, addressIP)
         
         else:
             print('MAX NUMBER OF HOPS REACHED')
 
 
-class WebServer(NetworkApplication):
+class ConnectionEngine:
+
+    # Accept loop shared by the TCP applications. Bytes received on a connection
+    # go to parse(tcpSocket, data), which returns the requests they completed
+    # (None when the connection has to be dropped), and only complete requests
+    # are handed to handler(tcpSocket, address, requests). In serial mode one
+    # connection is read and answered at a time. Otherwise a selectors loop reads
+    # every connection without blocking, and runs the handler inline (selector)
+    # or on a bounded pool of worker threads (threads), so a client sending
+    # slowly or sitting idle never holds up the others or a worker thread.
+    # A handler returning True keeps the connection open: it goes back to the
+    # loop, which closes it if the next request does not arrive within
+    # idleTimeout. Otherwise it is closed and onClose(tcpSocket) is called.
+    MODES = ('serial', 'threads', 'selector')
+    receiveSize = 64 * 1024
+
+    def __init__(self, handler, parse, mode='threads', threads=8, maxConnections=64, idleTimeout=5.0, onClose=None, metrics=None):
+        self.handler = handler
+        self.parse = parse
+        self.mode = mode
+        self.threads = max(1, threads)
+        self.maxConnections = max(1, maxConnections)
+        self.idleTimeout = idleTimeout
+        self.onClose = onClose
+        self.serverSocket = None
+        self.stopped = False
+        self.metrics = metrics or Metrics()
+        self.returned = deque() #(connection, address, whether it stays open) handed back by worker threads
+        self.waker = None #written to by worker threads to wake the loop up
+
+    def serve(self, serverSocket):
+        self.serverSocket = serverSocket
+        try:
+            if self.mode == 'serial':
+                self.serveSerial(serverSocket)
+            elif self.mode == 'selector':
+                self.serveLoop(serverSocket)
+            else:
+                self.serveThreads(serverSocket)
+        except KeyboardInterrupt:
+            print('Action terminated by Ctrl+C')
+        except OSError:
+            #Accepting fails once stop() shuts the listening socket down
+            if not self.stopped:
+                raise
+        finally:
+            serverSocket.close()
+
+    def stop(self):
+        #Make serve return from another thread, connections being served are finished first
+        self.stopped = True
+        if self.serverSocket is not None:
+            try:
+                self.serverSocket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.wake()
 
-    hostName = "localhost"
-    serverPort = 8080
+    def wake(self):
+        try:
+            self.waker.send(b'\0')
+        except (AttributeError, OSError):
+            pass #no loop running, or it is full of wakeups already
+
+    def read(self, tcpSocket, data):
+        #Requests completed by data received on a connection, None once it is closed or has to be dropped
+        self.metrics.count('bytes_received_total', len(data))
+        if not data:
+            return None
+        started = self.metrics.start()
+        try:
+            requests = self.parse(tcpSocket, data)
+        except Exception as e:
+            print(e)
+            requests = None
+        self.metrics.observe('parse', started)
+        return requests
 
-    def handleRequest(self, tcpSocket, address):
-        # 1. Receive request message from the client on connection socket
-        request = tcpSocket.recv(1024)
-        message = request.decode('utf-8').split()
-        path = message[1][1:] #taking away that initial '/' character by slicing the string
+    def dispatch(self, tcpSocket, address, requests):
+        #A failing handler must never take the accept loop down with it. The handler writes blocking, up to idleTimeout
+        tcpSocket.settimeout(self.idleTimeout)
+        try:
+            keepOpen = self.handler(tcpSocket, address, requests)
+        except Exception as e:
+            print(e)
+            keepOpen = False
+
+        if not keepOpen:
+            self.closeConnection(tcpSocket)
+        return keepOpen
 
+    def accepted(self):
+        self.metrics.count('connections_accepted_total')
+        self.metrics.adjust('connections_in_flight', 1)
+
+    def closeConnection(self, tcpSocket):
+        tcpSocket.close()
+        self.metrics.adjust('connections_in_flight', -1)
+        if self.onClose:
+            self.onClose(tcpSocket)
+
+    def serveSerial(self, serverSocket):
+        while not self.stopped:
+            tcpSocket, address = serverSocket.accept()
+            self.accepted()
+            self.serveConnection(tcpSocket, address)
+
+    def serveConnection(self, tcpSocket, address):
+        #Keep reading for as long as the handler wants the connection and the client keeps sending within idleTimeout
+        tcpSocket.settimeout(self.idleTimeout)
+        while True:
+            started = self.metrics.start()
+            try:
+                data = tcpSocket.recv(self.receiveSize)
+            except OSError:
+                data = b''
+            self.metrics.observe('recv', started)
+
+            requests = self.read(tcpSocket, data)
+            if requests is None:
+                self.closeConnection(tcpSocket)
+                return
+            if requests and not self.dispatch(tcpSocket, address, requests):
+                return
+
+    def serveThreads(self, serverSocket):
         try:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                self.serveLoop(serverSocket, pool)
+        finally:
+            #Connections the workers finished with after the loop stopped
+            while self.returned:
+                tcpSocket, address, keepOpen = self.returned.popleft()
+                if keepOpen:
+                    self.closeConnection(tcpSocket)
+
+    def runInPool(self, tcpSocket, address, requests, queued=0):
+        #Answer the requests on a worker thread, then hand the connection back to the loop
+        self.metrics.observe('accept', queued)
+        self.metrics.adjust('connections_queued', -1)
+        keepOpen = self.dispatch(tcpSocket, address, requests)
+        self.returned.append((tcpSocket, address, keepOpen))
+        self.wake()
+
+    def serveLoop(self, serverSocket, pool=None):
+        selector = selectors.DefaultSelector()
+        serverSocket.setblocking(False)
+        selector.register(serverSocket, selectors.EVENT_READ)
+        wakeup, self.waker = socket.socketpair()
+        wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        selector.register(wakeup, selectors.EVENT_READ)
+        listening = True
+        connections = 0 #open connections, waiting in the loop or being answered
+        deadlines = {} #idle deadline of every connection waiting in the loop for (the rest of) a request
+
+        def wait(tcpSocket, address):
+            tcpSocket.setblocking(False)
+            selector.register(tcpSocket, selectors.EVENT_READ, address)
+            deadlines[tcpSocket] = time.monotonic() + self.idleTimeout
+
+        def forget(tcpSocket):
+            selector.unregister(tcpSocket)
+            del deadlines[tcpSocket]
 
-            # 3. Opening the file
-            f = open(path, 'r')
+        try:
+            while not self.stopped:
+                timeout = None
+                if deadlines:
+                    timeout = max(0, min(deadlines.values()) - time.monotonic())
+
+                for key, events in selector.select(timeout):
+
+                    # 1. New connection, wait for its request before handing it over
+                    if key.fileobj is serverSocket:
+                        try:
+                            tcpSocket, address = serverSocket.accept()
+                        except BlockingIOError:
+                            continue
+                        self.accepted()
+                        connections += 1
+                        wait(tcpSocket, address)
+
+                    # 2. Worker threads finished with some connections, wait for the next request on the ones kept open
+                    elif key.fileobj is wakeup:
+                        try:
+                            wakeup.recv(4096)
+                        except BlockingIOError:
+                            pass
+                        while self.returned:
+                            tcpSocket, address, keepOpen = self.returned.popleft()
+                            if keepOpen:
+                                wait(tcpSocket, address)
+                            else:
+                                connections -= 1
+
+                    # 3. Data is waiting on a client connection, read it without blocking and hand over only complete requests
+                    else:
+                        tcpSocket = key.fileobj
+                        try:
+                            data = tcpSocket.recv(self.receiveSize)
+                        except BlockingIOError:
+                            continue
+                        except OSError:
+                            data = b''
+
+                        requests = self.read(tcpSocket, data)
+                        if requests is None:
+                            forget(tcpSocket)
+                            self.closeConnection(tcpSocket)
+                            connections -= 1
+                        elif not requests:
+                            deadlines[tcpSocket] = time.monotonic() + self.idleTimeout
+                        else:
+                            forget(tcpSocket)
+                            if pool is not None:
+                                self.metrics.adjust('connections_queued', 1)
+                                pool.submit(self.runInPool, tcpSocket, key.data, requests, self.metrics.start())
+                            elif self.dispatch(tcpSocket, key.data, requests):
+                                wait(tcpSocket, key.data)
+                            else:
+                                connections -= 1
+
+                # 4. Close connections which stayed idle for too long
+                now = time.monotonic()
+                for tcpSocket in [s for s, deadline in deadlines.items() if deadline <= now]:
+                    forget(tcpSocket)
+                    self.closeConnection(tcpSocket)
+                    connections -= 1
+
+                # 5. Stop accepting once full, further clients wait in the listen backlog
+                if listening and connections >= self.maxConnections:
+                    selector.unregister(serverSocket)
+                    listening = False
+                elif not listening and connections < self.maxConnections:
+                    selector.register(serverSocket, selectors.EVENT_READ)
+                    listening = True
+        finally:
+            for tcpSocket in list(deadlines):
+                forget(tcpSocket)
+                self.closeConnection(tcpSocket)
+            selector.close()
+            self.waker.close()
+            wakeup.close()
+
+
+class Supervisor:
+
+    # Pre-fork process manager for the web server and the proxy. The process
+    # calling fork() stays behind to supervise, while each worker returns from it
+    # and carries on starting a server of its own, listening with SO_REUSEPORT on
+    # the same address so the kernel spreads connections across the workers.
+    # Whatever was set up before fork() is shared copy-on-write. A worker which
+    # dies is replaced, after a growing delay while it keeps dying young. SIGHUP
+    # replaces every worker, starting the new ones before the old ones are told
+    # to stop, and SIGTERM or Ctrl+C stops them all, giving them graceTimeout to
+    # finish the connections they are serving before they are killed.
+    graceTimeout = 10
+    minUptime = 5 #workers dying sooner than this after starting are restarted with a backoff
+    maxBackoff = 30
+    handover = 1 #seconds new workers get to start listening before the ones they replace stop
+    pollInterval = 0.2
+
+    def __init__(self, workers, address, stop):
+        self.workers = workers
+        self.address = address
+        self.stop = stop #stops a worker's server gracefully, called when it gets SIGTERM
+        self.children = {} #pid -> (worker number, started)
+        self.retiring = {} #pid of a replaced worker -> when it is told to stop
+        self.backoff = {} #worker number -> seconds waited before its last restart
+        self.stopping = False
+        self.reloading = False
+
+    def fork(self):
+        #Returns the worker number in every worker, and None in the supervisor once all of them have stopped
+        # 1. Hold the address with a socket which never listens, so a bad or busy one fails here rather than in every worker.
+        #    It is bound without SO_REUSEPORT first, which any other server of the same user could otherwise share it through
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind(self.address)
+        self.placeholder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.placeholder.bind(self.address)
+
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.signalled)
+        starts = {number: 0 for number in range(self.workers)} #worker number -> when it is due to start
+        killAt = None
+        print('Supervising %d workers on %s:%d (pid %d)' % (self.workers, self.address[0], self.address[1], os.getpid()))
+        if NetworkApplication.output is not None:
+            NetworkApplication.output.writeHeader()
+
+        while self.children or (starts and not self.stopping):
+            now = time.monotonic()
+
+            # 2. Start the workers which are due, each one returning from here in its own process
+            for number, due in list(starts.items()):
+                if due <= now and not self.stopping:
+                    del starts[number]
+                    sys.stdout.flush() #or the child prints whatever is still buffered once more
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        self.becomeWorker(number)
+                        return number
+                    self.children[pid] = (number, now)
+                    print('Worker %d started (pid %d)' % (number, pid))
+
+            # 3. On SIGHUP start a replacement for every worker, the old ones stop once the new ones are listening
+            if self.reloading and not self.stopping:
+                self.reloading = False
+                for pid, (number, started) in self.children.items():
+                    if pid not in self.retiring:
+                        self.retiring[pid] = now + self.handover
+                        starts[number] = now
+            for pid, when in self.retiring.items():
+                if when is not None and when <= now:
+                    self.retiring[pid] = None
+                    self.kill(pid, signal.SIGTERM)
+
+            # 4. Reap the workers which exited, restarting the ones which were not meant to
+            while self.children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if pid == 0:
+                    break
+                number, started = self.children.pop(pid)
+                if pid in self.retiring or self.stopping:
+                    self.retiring.pop(pid, None)
+                    continue
+                delay = 0
+                if now - started < self.minUptime:
+                    delay = min(self.maxBackoff, max(1, 2 * self.backoff.get(number, 0)))
+                self.backoff[number] = delay
+                starts[number] = now + delay
+                print('Worker %d (pid %d) exited with status %d, restarting in %ds' % (
+                    number, pid, os.waitstatus_to_exitcode(status), delay))
+
+            # 5. Stop every worker gracefully on SIGTERM or Ctrl+C, killing those still busy after graceTimeout
+            if self.stopping and killAt is None:
+                killAt = now + self.graceTimeout
+                for pid in self.children:
+                    self.kill(pid, signal.SIGTERM)
+            elif killAt is not None and now >= killAt:
+                for pid in self.children:
+                    self.kill(pid, signal.SIGKILL)
+                killAt = float('inf')
+
+            time.sleep(self.pollInterval)
+
+        self.placeholder.close()
+        print('All workers stopped')
+        return None
+
+    def becomeWorker(self, number):
+        #Ctrl+C reaches the whole process group, but only the supervisor decides when workers stop
+        self.placeholder.close()
+        if NetworkApplication.output is not None:
+            NetworkApplication.output = NetworkApplication.output.forWorker(number)
+        self.children.clear()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+
+    def signalled(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
 
-            # 4. Store in temporary buffer
-            outputdata = f.read()
-            #print(outputdata)
+    def kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass #already exited, it is reaped on the next pass
+
+
+class FileCache:
+
+    # Bounded LRU cache of small hot files for the web server. Entries are keyed by
+    # path and only served while the file's mtime still matches, so an edited file
+    # is read again on its next request. Files over maxFileSize are never cached.
+    def __init__(self, maxBytes, maxFileSize):
+        self.maxBytes = maxBytes
+        self.maxFileSize = maxFileSize
+        self.entries = OrderedDict() #path -> (mtime, contents), least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def accepts(self, fileSize):
+        return self.maxBytes > 0 and fileSize <= min(self.maxFileSize, self.maxBytes)
+
+    def get(self, path, mtime):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != mtime:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, mtime, contents):
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old[1])
+
+            self.entries[path] = (mtime, contents)
+            self.size += len(contents)
+
+            #Evict the least recently used files until the cache fits its byte budget again
+            while self.size > self.maxBytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def warm(self, root):
+        #Reads the files under root into the cache, smallest first so as many as possible fit
+        if self.maxBytes <= 0:
+            return
+        candidates = []
+        for directory, subdirectories, files in os.walk(root):
+            subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+            for name in files:
+                path = os.path.relpath(os.path.join(directory, name), root)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if self.accepts(stat.st_size):
+                    candidates.append((stat.st_size, path, stat.st_mtime_ns))
+
+        for size, path, mtime in sorted(candidates):
+            if self.size + size > self.maxBytes:
+                break
+            try:
+                with open(path, 'rb') as f:
+                    self.put(path, mtime, f.read())
+            except OSError:
+                continue
+
+    def stats(self):
+        return 'file cache: %d hits, %d misses, %d files, %d bytes' % (self.hits, self.misses, len(self.entries), self.size)
+
+
+class Compression:
+
+    # Content coding negotiation shared by the web server and the proxy. Bodies
+    # are gzip or deflate coded for clients which accept it, as long as their type
+    # compresses well and they are at least minSize bytes. Compressed variants are
+    # kept in a bounded LRU keyed by (path or URL, encoding, version), so a hot
+    # object is compressed once per version instead of on every request, and one
+    # found not worth compressing is remembered as such for that version.
+    ENCODINGS = ('gzip', 'deflate') #in order of preference between equal weights
+    maxRefused = 4096
+    windowBits = {'gzip': 31, 'deflate': 15} #deflate in HTTP is the zlib format
+    level = 6
+    maxObjectSize = 8 << 20 #larger bodies go out as they are, rather than holding up the first byte
+    types = ('text/', 'application/javascript', 'application/json', 'application/xml', 'application/xhtml+xml',
+             'image/svg+xml')
+
+    def __init__(self, maxBytes, minSize=1024, enabled=True):
+        self.maxBytes = maxBytes
+        self.minSize = minSize
+        self.enabled = enabled
+        self.variants = OrderedDict() #(key, encoding, version) -> compressed body, least recently used first
+        self.refused = OrderedDict() #(key, version) of objects not worth compressing, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def negotiate(self, acceptEncoding):
+        #The coding the client weighs highest in its Accept-Encoding, None for neither gzip nor deflate
+        if not self.enabled or not acceptEncoding:
+            return None
+        weights = {}
+        for item in acceptEncoding.lower().split(','):
+            coding, _, parameters = item.partition(';')
+            name, _, value = parameters.partition('=')
+            try:
+                weights[coding.strip()] = float(value) if name.strip() == 'q' else 1.0
+            except ValueError:
+                weights[coding.strip()] = 0.0
+
+        best, bestWeight = None, 0.0
+        for encoding in self.ENCODINGS:
+            weight = weights.get(encoding, weights.get('*', 0.0))
+            if weight > bestWeight:
+                best, bestWeight = encoding, weight
+        return best
+
+    def accepts(self, contentType, size=None):
+        #Whether a body of this type and size (None when not known up front) is worth compressing
+        if not self.enabled:
+            return False
+        if size is not None and not self.minSize <= size <= self.maxObjectSize:
+            return False
+        contentType = contentType.split(';')[0].strip().lower()
+        return contentType.startswith(self.types) or contentType.endswith(('+xml', '+json'))
+
+    def variantTag(self, etag, encoding):
+        #Each coding is a representation of its own, so it needs an ETag of its own
+        return etag[:-1] + '-' + encoding + '"' if etag.endswith('"') else etag
+
+    def compressor(self, encoding):
+        return zlib.compressobj(self.level, zlib.DEFLATED, self.windowBits[encoding])
+
+    def compress(self, encoding, chunks):
+        #Compress the body as it is read, one chunk at a time
+        compressor = self.compressor(encoding)
+        parts = [compressor.compress(chunk) for chunk in chunks]
+        parts.append(compressor.flush())
+        return b''.join(parts)
+
+    def get(self, key, encoding, version):
+        with self.lock:
+            body = self.variants.get((key, encoding, version))
+            if body is None:
+                self.misses += 1
+                return None
+
+            self.variants.move_to_end((key, encoding, version))
+            self.hits += 1
+            return body
+
+    def put(self, key, encoding, version, body):
+        if len(body) > self.maxBytes:
+            return
+
+        with self.lock:
+            old = self.variants.pop((key, encoding, version), None)
+            if old is not None:
+                self.size -= len(old)
+
+            self.variants[(key, encoding, version)] = body
+            self.size += len(body)
+
+            #Evict the least recently used variants until they fit their byte budget again, older versions go first
+            while self.size > self.maxBytes:
+                _, evicted = self.variants.popitem(last=False)
+                self.size -= len(evicted)
+
+    def refuse(self, key, version):
+        #Remember that this version of an object is not worth compressing, so it is not looked into again
+        with self.lock:
+            self.refused[(key, version)] = True
+            self.refused.move_to_end((key, version))
+            if len(self.refused) > self.maxRefused:
+                self.refused.popitem(last=False)
+
+    def isRefused(self, key, version):
+        with self.lock:
+            if (key, version) not in self.refused:
+                return False
+            self.refused.move_to_end((key, version))
+            return True
+
+    def stats(self):
+        return 'compressed variants: %d hits, %d misses, %d variants, %d bytes' % (
+            self.hits, self.misses, len(self.variants), self.size)
+
+
+class HttpError(Exception):
+
+    # A request which cannot be answered normally, carrying the status line
+    # the server should answer it with before closing the connection.
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class HttpRequest:
+
+    # One parsed request. headers is keyed by lower case name, headerLines keeps
+    # the original lines in order for forwarding, and body is already de-chunked.
+    def __init__(self, method, target, version, headerLines):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headerLines = headerLines #[(name, value)] as sent
+        self.headers = {}
+        for name, value in headerLines:
+            key = name.lower()
+            self.headers[key] = self.headers[key] + ', ' + value if key in self.headers else value
+        self.body = b''
+
+    def keepAlive(self):
+        #HTTP/1.1 connections are persistent unless the client asks otherwise, HTTP/1.0 ones only on request
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return 'close' not in connection
+        return 'keep-alive' in connection
+
+
+class RequestParser:
+
+    # Incremental HTTP/1.x request parser shared by the web server and the proxy.
+    # Bytes are fed in as they arrive, into one buffer kept for the connection, and
+    # every request completed by them is returned, so partial reads, pipelined
+    # requests, Content-Length and chunked bodies all go through the same path. The
+    # search for the end of the head resumes where the last one stopped instead of
+    # rescanning, and heads and bodies over their limits are refused with 431/413.
+    def __init__(self, maxHeadSize=64 * 1024, maxBodySize=1 << 20):
+        self.maxHeadSize = maxHeadSize
+        self.maxBodySize = maxBodySize
+        self.buffer = bytearray()
+        self.scanned = 0 #bytes of the buffer already searched for the end of the head
+        self.request = None #request whose body is being read
+        self.remaining = 0 #body (or current chunk) bytes still expected
+        self.chunked = False
+        self.state = 'head'
+
+    def idle(self):
+        #True between requests, with nothing half received
+        return self.state == 'head' and not self.buffer
+
+    def feed(self, data):
+        self.buffer += data
+        requests = []
+        while True:
+            request = self.step()
+            if request is None:
+                return requests
+            requests.append(request)
 
-            header = 'HTTP/1.0 200 OK\n' #message which informs server the request was handled OK
-        except IOError:
+    def step(self):
+        #Parse as far as the buffer allows, returns the request once it is complete
+        while True:
+            if self.state == 'head':
+                if not self.parseHead():
+                    return None
+            elif self.state == 'body':
+                if len(self.buffer) < self.remaining:
+                    return None
+                self.request.body = bytes(self.buffer[:self.remaining])
+                del self.buffer[:self.remaining]
+                return self.finish()
+            elif self.state == 'size':
+                end = self.buffer.find(b'\n')
+                if end < 0:
+                    self.checkLine()
+                    return None
+                size = bytes(self.buffer[:end]).split(b';')[0].strip()
+                del self.buffer[:end + 1]
+                try:
+                    self.remaining = int(size, 16)
+                except ValueError:
+                    raise HttpError('400 Bad Request')
+                if len(self.request.body) + self.remaining > self.maxBodySize:
+                    raise HttpError('413 Payload Too Large')
+                self.state = 'chunk' if self.remaining else 'trailer'
+            elif self.state == 'chunk':
+                end = self.buffer.find(b'\n', self.remaining)
+                if end < 0:
+                    return None
+                self.request.body += self.buffer[:self.remaining]
+                del self.buffer[:end + 1]
+                self.state = 'size'
+            elif self.state == 'trailer':
+                end = self.buffer.find(b'\n')
+                if end < 0:
+                    self.checkLine()
+                    return None
+                line = self.buffer[:end].strip()
+                del self.buffer[:end + 1]
+                if not line:
+                    self.request.body = bytes(self.request.body)
+                    return self.finish()
+
+    def parseHead(self):
+        # 1. Find the blank line ending the head, only searching bytes which arrived since the last attempt
+        start = max(0, self.scanned - 2)
+        ends = [end for end in (self.buffer.find(b'\n\r\n', start), self.buffer.find(b'\n\n', start)) if end >= 0]
+        if not ends:
+            self.scanned = len(self.buffer)
+            if self.scanned > self.maxHeadSize:
+                raise HttpError('431 Request Header Fields Too Large')
+            return False
+        end = min(ends)
+        length = end + (3 if self.buffer[end + 1] == 13 else 2)
+        if end > self.maxHeadSize:
+            raise HttpError('431 Request Header Fields Too Large')
+
+        # 2. Split the request line and the headers, tolerating bare newlines
+        lines = bytes(self.buffer[:end]).decode('iso-8859-1').split('\n')
+        del self.buffer[:length]
+        self.scanned = 0
+        while lines and not lines[0].strip():
+            lines.pop(0) #stray blank lines between pipelined requests
+        parts = lines[0].split() if lines else []
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpError('400 Bad Request')
+
+        headerLines = []
+        for line in lines[1:]:
+            name, separator, value = line.rstrip('\r').partition(':')
+            if not separator or not name.strip():
+                raise HttpError('400 Bad Request')
+            headerLines.append((name.strip(), value.strip()))
+        self.request = HttpRequest(parts[0], parts[1], parts[2], headerLines)
+
+        # 3. Work out how the body, if any, is framed
+        if 'chunked' in self.request.headers.get('transfer-encoding', '').lower():
+            self.request.body = bytearray()
+            self.state = 'size'
+        else:
+            length = self.request.headers.get('content-length', '0').strip()
+            if not length.isdigit():
+                raise HttpError('400 Bad Request')
+            if int(length) > self.maxBodySize:
+                raise HttpError('413 Payload Too Large')
+            self.remaining = int(length)
+            self.state = 'body'
+        return True
 
-            # 5. Send the correct HTTP response error
-            print("Could not read file:", path)
-            outputdata = 'Error 404: File not found'
-            header = 'HTTP/1.0 404 Not Found\n\n' #message informing of error, 404 file not found
-
-        header += 'Content-Type: text/html\n\n'
-        # 6. Send the content of the file to the socket
-        finalOutput = header.encode()
-        finalOutput += outputdata.encode()
-        tcpSocket.send(finalOutput)
-        print(header)
-        # 7. Close the connection socket
-        tcpSocket.close()
-       
-        pass
+    def checkLine(self):
+        if len(self.buffer) > self.maxHeadSize:
+            raise HttpError('431 Request Header Fields Too Large')
 
-    def __init__(self, args):
+    def finish(self):
+        request, self.request = self.request, None
+        self.state = 'head'
+        return request
+
+
+class WebServer(NetworkApplication):
+
+    hostName = "localhost"
+    serverPort = 8080
+    idleTimeout = 5
+    maxRequests = 100
+    sendfileChunk = 1 << 20 #bytes handed to sendfile per call when streaming large files
+    maxHeadSize = 64 * 1024
+    maxBodySize = 1 << 20 #largest request body accepted, static files need none
+    maxRanges = 16 #most byte ranges answered in one multipart response
+    maxValidators = 4096 #files whose ETag and Last-Modified are kept
+    compressChunk = 64 * 1024 #bytes of a file read into the compressor at a time
+    worker = None #number of this worker process, None unless --workers forks several
+
+    def __init__(self, args, run=True):
         print('Web Server starting on port: %i...' % (args.port))
         self.serverPort = args.port
-        
+        self.idleTimeout = args.idle_timeout
+        self.maxRequests = args.max_requests
+        self.served = {} #number of requests answered on each open connection
+        self.parsers = {} #RequestParser of each open connection, holding any partly received request
+        self.validatorCache = OrderedDict() #path -> ((mtime, size, inode), ETag, Last-Modified), least recently used first
+        self.validatorLock = threading.Lock()
+        self.fileCache = FileCache(args.cache_size, args.cache_file_limit)
+        self.compression = Compression(args.compression_cache, args.compress_min_size, not args.no_compression)
+        host = args.host or socket.gethostname()
+
+        #With several workers this process only supervises them, every worker carries on from here with a socket of its own.
+        #Files cached before they are forked are shared by all of them
+        if args.workers > 1:
+            self.fileCache.warm('.')
+            print(self.fileCache.stats())
+            self.worker = Supervisor(args.workers, (host, self.serverPort), self.stop).fork()
+            if self.worker is None:
+                return
+        self.startInstrumentation(args)
+        self.metrics.register('file_cache_hits_total', 'counter', lambda: self.fileCache.hits)
+        self.metrics.register('file_cache_misses_total', 'counter', lambda: self.fileCache.misses)
+        self.metrics.register('file_cache_files', 'gauge', lambda: len(self.fileCache.entries))
+        self.metrics.register('file_cache_bytes', 'gauge', lambda: self.fileCache.size)
+        self.metrics.register('compressed_variant_hits_total', 'counter', lambda: self.compression.hits)
+        self.metrics.register('compressed_variant_misses_total', 'counter', lambda: self.compression.misses)
+        self.metrics.register('compressed_variant_bytes', 'gauge', lambda: self.compression.size)
+
         # 1. Create server socket
         s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s1.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR, 1)
-        host = socket.gethostname()
+        if self.worker is not None:
+            s1.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         # 2. Bind the server socket to server address and server port
         s1.bind((host, self.serverPort))
+        self.serverSocket = s1
+        self.address = s1.getsockname()
 
         # 3. Continuously listen for connections to server socket
-        s1.listen(1)
+        s1.listen(args.backlog)
         print(host)
-        
+
+        # 4. Serve connections using the selected concurrency mode
+        #http://vdi-scc203-17:1025/index.html for testing
+        self.engine = ConnectionEngine(self.handleRequest, self.parse, args.mode, args.threads, args.max_connections,
+                                       self.idleTimeout, self.connectionClosed, self.metrics)
+        print('Serving in %s mode (backlog %d, max %d connections)' % (args.mode, args.backlog, args.max_connections))
+
+        #Left to the caller when run is False, e.g. to serve from a thread of its own
+        if run:
+            self.run()
+
+    def run(self):
+        # 5. Close server socket once the engine stops
+        self.engine.serve(self.serverSocket)
+        print(self.fileCache.stats())
+        print(self.compression.stats())
+        self.stopInstrumentation()
+
+    def stop(self):
+        self.engine.stop()
+
+    def connectionClosed(self, tcpSocket):
+        self.served.pop(tcpSocket, None)
+        self.parsers.pop(tcpSocket, None)
+
+    def parse(self, tcpSocket, data):
+        # 1. Receive request messages from the client on connection socket, the engine hands over each read as it
+        #    arrives. Several requests may arrive back to back on one connection (pipelining) or one may take several reads
+        parser = self.parsers.get(tcpSocket)
+        if parser is None:
+            parser = self.parsers[tcpSocket] = RequestParser(self.maxHeadSize, self.maxBodySize)
+        try:
+            return parser.feed(data)
+        except HttpError as e:
+            self.refuse(tcpSocket, e.status)
+            return None
+
+    def handleRequest(self, tcpSocket, address, requests):
+        # 2. Answer every request the new bytes completed, in the order they were sent
+        for request in requests:
+            self.metrics.adjust('requests_in_flight', 1)
+            try:
+                keepAlive = self.respond(tcpSocket, request)
+            finally:
+                self.metrics.adjust('requests_in_flight', -1)
+            if not keepAlive:
+                return False
+
+        # 3. Every request answered, hand the connection back until the client sends the next one
+        return True
+
+    def refuse(self, tcpSocket, status):
+        #Answer a request which could not be parsed, the connection is closed after it
+        body = ('Error %s' % status).encode()
+        header = self.responseHeader('HTTP/1.1', status, 'text/html', len(body), False)
+        tcpSocket.settimeout(self.idleTimeout)
+        tcpSocket.sendall(header.encode() + body)
+        self.metrics.count('requests_total{status="%s"}' % status.split()[0])
+        print(header)
+
+    def respond(self, tcpSocket, request):
+        started = time.perf_counter()
+        method = request.method
+        path = request.target[1:] #taking away that initial '/' character by slicing the string
+        version = 'HTTP/1.1' if request.version == 'HTTP/1.1' else 'HTTP/1.0'
+
+        # 1. Decide whether the connection stays open after this response
+        served = self.served.get(tcpSocket, 0) + 1
+        self.served[tcpSocket] = served
+        keepAlive = request.keepAlive() and served < self.maxRequests
+
+        # 2. Metrics and profiles are answered by the server itself
+        report = self.instrumentation(request.target)
+        if report is not None:
+            body = report.encode()
+            header = self.responseHeader(version, '200 OK', 'text/plain; version=0.0.4', len(body), keepAlive)
+            tcpSocket.sendall(header.encode() + body)
+            return keepAlive
+
+        try:
+
+            # 3. Opening the file in binary mode so any type of file can be served unchanged
+            f = open(path, 'rb')
+        except IOError:
+
+            # 5. Send the correct HTTP response error
+            print("Could not read file:", path)
+            body = b'Error 404: File not found'
+            header = self.responseHeader(version, '404 Not Found', 'text/html', len(body), keepAlive) #message informing of error, 404 file not found
+            sending = self.metrics.start()
+            tcpSocket.sendall(header.encode() + (body if method != 'HEAD' else b''))
+            self.metrics.observe('send', sending)
+            self.metrics.count('bytes_sent_total', len(header) + len(body))
+            self.metrics.count('requests_total{status="404"}')
+            print(header)
+            self.emit('request', method=method, path=request.target, status=404, bytes=len(body),
+                      duration=(time.perf_counter() - started) * 1000)
+            return keepAlive
+
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            contentType = self.contentType(path)
+
+            # 4. Validators of this version of the file, worked out once and reused until it changes
+            etag, lastModified = self.validators(path, stat)
+
+            # 5. Compressible files go out gzip or deflate coded to clients accepting it, whole files only since ranges
+            #    are served from the file as it is. The coded file is a representation with an ETag of its own
+            encoding = None
+            compressible = self.compression.accepts(contentType, size)
+            if compressible and method in ('GET', 'HEAD') and 'range' not in request.headers:
+                encoding = self.compression.negotiate(request.headers.get('accept-encoding', ''))
+            versionTag = etag
+            if encoding is not None:
+                etag = self.compression.variantTag(etag, encoding)
+            extra = ['ETag: %s' % etag, 'Last-Modified: %s' % lastModified, 'Accept-Ranges: bytes']
+            if compressible:
+                extra.append('Vary: Accept-Encoding')
+
+            # 6. Work out the status and which parts of the file go out: a 304 when the client's copy is current,
+            #    206 for satisfiable byte ranges, 416 for unsatisfiable ones and 200 for the whole file
+            ranges = None
+            if method in ('GET', 'HEAD') and self.notModified(request, etag, stat.st_mtime):
+                status = '304 Not Modified'
+            else:
+                ranges = self.requestedRanges(request, etag, lastModified, size) if method == 'GET' else None
+                status = '200 OK' if ranges is None else '206 Partial Content' if ranges else '416 Range Not Satisfiable'
+
+            contents = None
+            if status == '200 OK' and encoding is not None:
+                contents = self.compressedVariant(f, path, versionTag, encoding)
+                extra.append('Content-Encoding: %s' % encoding)
+                header = self.responseHeader(version, status, contentType, len(contents), keepAlive, extra)
+                parts = [(header.encode(), 0, len(contents) if method != 'HEAD' else 0)]
+            elif status == '200 OK':
+                header = self.responseHeader(version, status, contentType, size, keepAlive, extra) #message which informs server the request was handled OK
+                parts = [(header.encode(), 0, size if method != 'HEAD' else 0)]
+            elif status == '206 Partial Content' and len(ranges) == 1:
+                first, last = ranges[0]
+                extra.append('Content-Range: bytes %d-%d/%d' % (first, last, size))
+                header = self.responseHeader(version, status, contentType, last - first + 1, keepAlive, extra)
+                parts = [(header.encode(), first, last - first + 1)]
+            elif status == '206 Partial Content':
+                parts = self.multipartRanges(version, contentType, ranges, size, keepAlive, extra)
+                header = parts[0][0].decode()
+            else:
+                if status != '304 Not Modified':
+                    extra = ['Content-Range: bytes */%d' % size]
+                header = self.responseHeader(version, status, None, 0 if ranges is not None else None, keepAlive, extra)
+                parts = [(header.encode(), 0, 0)]
+
+            # 7. Small hot files are answered straight from memory, the rest is left on disk
+            if contents is None and any(length for _, _, length in parts) and self.fileCache.accepts(size):
+                lookup = self.metrics.start()
+                contents = self.fileCache.get(path, stat.st_mtime_ns)
+                self.metrics.observe('cache_lookup', lookup)
+                if contents is None:
+                    contents = f.read()
+                    self.fileCache.put(path, stat.st_mtime_ns, contents)
+
+            # 8. Send the header and the parts of the file asked for
+            sending = self.metrics.start()
+            self.sendParts(tcpSocket, f, contents, parts)
+            self.metrics.observe('send', sending)
+            sent = sum(len(prefix) + length for prefix, _, length in parts)
+            self.metrics.count('bytes_sent_total', sent)
+            self.metrics.count('requests_total{status="%s"}' % status.split()[0])
+            print(header)
+
+        self.emit('request', method=method, path=request.target, status=int(status.split()[0]), bytes=sent,
+                  duration=(time.perf_counter() - started) * 1000)
+        return keepAlive
+
+    def responseHeader(self, version, status, contentType, contentLength, keepAlive, extra=()):
+        header = '%s %s\r\n' % (version, status)
+        if contentType is not None:
+            header += 'Content-Type: %s\r\n' % contentType
+        if contentLength is not None:
+            header += 'Content-Length: %d\r\n' % contentLength
+        for line in extra:
+            header += line + '\r\n'
+        header += 'Connection: %s\r\n\r\n' % ('keep-alive' if keepAlive else 'close')
+        return header
+
+    def validators(self, path, stat):
+        #ETag and Last-Modified of a file, cached per path for as long as its mtime and size stay the same
+        version = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        with self.validatorLock:
+            cached = self.validatorCache.get(path)
+            if cached is not None and cached[0] == version:
+                self.validatorCache.move_to_end(path)
+                return cached[1], cached[2]
+
+        etag = '"%x-%x-%x"' % (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        lastModified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        with self.validatorLock:
+            self.validatorCache[path] = (version, etag, lastModified)
+            self.validatorCache.move_to_end(path)
+            if len(self.validatorCache) > self.maxValidators:
+                self.validatorCache.popitem(last=False)
+        return etag, lastModified
+
+    def notModified(self, request, etag, mtime):
+        #If-None-Match takes precedence, If-Modified-Since is only looked at without it
+        match = request.headers.get('if-none-match')
+        if match is not None:
+            tags = [tag.strip() for tag in match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        since = request.headers.get('if-modified-since')
+        if since:
+            try:
+                return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def requestedRanges(self, request, etag, lastModified, size):
+        #Returns None to send the whole file, otherwise the satisfiable (first, last) byte ranges asked for,
+        #sorted with overlapping ones merged, which is empty when none of them can be satisfied
+        header = request.headers.get('range', '').strip()
+        if not header.startswith('bytes='):
+            return None
+
+        #If-Range asks for the ranges only while the file is still the version the client has part of
+        ifRange = request.headers.get('if-range')
+        if ifRange is not None and ifRange.strip() not in (etag, lastModified):
+            return None
+
+        ranges = []
+        for spec in header[6:].split(','):
+            first, dash, last = spec.strip().partition('-')
+            if not dash or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) or (last and not last.isdigit()):
+                return None
+            if not first:
+                #Suffix range, the last so many bytes
+                if int(last) > 0 and size > 0:
+                    ranges.append((max(0, size - int(last)), size - 1))
+            elif last and int(last) < int(first):
+                return None
+            elif int(first) < size:
+                ranges.append((int(first), min(int(last), size - 1) if last else size - 1))
+
+        #Lots of small ranges cost more than they save, answer them with the whole file instead
+        if len(ranges) > self.maxRanges:
+            return None
+
+        merged = []
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def multipartRanges(self, version, contentType, ranges, size, keepAlive, extra):
+        #Parts of a multipart/byteranges response, the header going out with the first one
+        boundary = '%016x' % random.getrandbits(64)
+        heads = [('\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                  % (boundary, contentType, first, last, size)).encode() for first, last in ranges]
+        closing = ('\r\n--%s--\r\n' % boundary).encode()
+        length = sum(map(len, heads)) + sum(last - first + 1 for first, last in ranges) + len(closing)
+
+        header = self.responseHeader(version, '206 Partial Content', 'multipart/byteranges; boundary=' + boundary,
+                                     length, keepAlive, extra)
+        parts = [(head, first, last - first + 1) for head, (first, last) in zip(heads, ranges)]
+        parts[0] = (header.encode() + parts[0][0], parts[0][1], parts[0][2])
+        parts.append((closing, 0, 0))
+        return parts
+
+    def sendParts(self, tcpSocket, f, contents, parts):
+        #Each part is a prefix followed by a slice of the file, sent from memory when the file is cached
+        for prefix, offset, length in parts:
+            if contents is not None:
+                tcpSocket.sendall(prefix + contents[offset:offset + length])
+            else:
+                tcpSocket.sendall(prefix)
+                self.sendFile(tcpSocket, f, length, offset)
+
+    def sendFile(self, tcpSocket, f, size, offset=0):
+        #Stream the file from the page cache to the socket with sendfile, in slices so large files never sit in memory
+        end = offset + size
+        while offset < end:
+            sent = tcpSocket.sendfile(f, offset, min(self.sendfileChunk, end - offset))
+            if sent == 0:
+                break
+            offset += sent
+
+    def compressedVariant(self, f, path, etag, encoding):
+        #The file coded with encoding, from the variant cache or compressed slice by slice as it is read and then kept
+        lookup = self.metrics.start()
+        contents = self.compression.get(path, encoding, etag)
+        self.metrics.observe('cache_lookup', lookup)
+        if contents is None:
+            compressing = self.metrics.start()
+            contents = self.compression.compress(encoding, iter(lambda: f.read(self.compressChunk), b''))
+            self.compression.put(path, encoding, etag, contents)
+            self.metrics.observe('compress', compressing)
+        return contents
+
+    def contentType(self, path):
+        #Files without a recognised extension keep being served as HTML
+        contentType, _ = mimetypes.guess_type(path)
+        return contentType or 'text/html'
+
+
+class CachedResponse:
+
+    # One response held by the ResponseCache: the origin's raw bytes plus the
+    # expiry time and validators needed to decide freshness and revalidate it.
+    # version is drawn when the response is stored and kept while it is
+    # revalidated, telling apart the bodies compressed variants were made from.
+    def __init__(self, response, expires, etag=None, lastModified=None, version=None):
+        self.response = response
+        self.expires = expires
+        self.etag = etag
+        self.lastModified = lastModified
+        self.version = version or '%016x' % random.getrandbits(64)
+
+    def isFresh(self):
+        return time.time() < self.expires
+
+
+class DiskCache:
+
+    # Persistent second tier under the ResponseCache. Responses are appended to
+    # segment files and located through an append-only JSON lines index, so a
+    # restart only reads the index and never the bodies. Bodies are served as
+    # memoryviews over mmaps of the segments, without copying them into Python
+    # objects. Once the segments outgrow maxBytes the oldest ones are dropped whole
+    # and the index is rewritten without their entries. Segments are an eighth of
+    # the budget (64 MiB at most), so dropping one frees a useful share of it.
+    maxSegmentSize = 64 << 20
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.segmentSize = max(1, min(self.maxSegmentSize, maxBytes // 8)) #a new segment file is started once the current one reaches this size
+        self.index = {} #key -> record (segment, offset, length, expires, etag, lastModified)
+        self.segments = {} #segment number -> bytes written to it
+        self.maps = {} #segment number -> mmap over it
+        self.hits = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.startswith('segment-') and name.endswith('.dat'):
+                self.segments[int(name[8:-4])] = os.path.getsize(os.path.join(directory, name))
+        self.current = max(self.segments, default=0)
+        self.segments.setdefault(self.current, 0)
+
+        self.loadIndex()
+        self.indexFile = open(os.path.join(directory, 'index'), 'a')
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, 'segment-%06d.dat' % segment)
+
+    def loadIndex(self):
+        #Replay the index, later records win and records for missing or truncated segments are ignored
+        try:
+            f = open(os.path.join(self.directory, 'index'))
+        except FileNotFoundError:
+            return
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue #a torn write at the end of the index
+
+                if record.get('deleted'):
+                    self.index.pop(record['key'], None)
+                elif record['offset'] + record['length'] <= self.segments.get(record['segment'], -1):
+                    self.index[record['key']] = record
+
+    def get(self, key):
+        with self.lock:
+            record = self.index.get(key)
+            if record is None:
+                return None
+
+            # 1. Map the segment, again if it has grown past the end of the current mapping
+            segment, offset, length = record['segment'], record['offset'], record['length']
+            segmentMap = self.maps.get(segment)
+            if segmentMap is None or len(segmentMap) < offset + length:
+                with open(self.segmentPath(segment), 'rb') as f:
+                    segmentMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = segmentMap
+
+            # 2. Hand out a view straight over the mapping
+            self.hits += 1
+            response = memoryview(segmentMap)[offset:offset + length]
+            return CachedResponse(response, record['expires'], record['etag'], record['lastModified'], record.get('version'))
+
+    def put(self, key, entry):
+        with self.lock:
+            # 1. Append the body to the current segment, starting a new one when it is full
+            if self.segments[self.current] >= self.segmentSize:
+                self.current += 1
+                self.segments[self.current] = 0
+
+            offset = self.segments[self.current]
+            with open(self.segmentPath(self.current), 'ab') as f:
+                f.write(entry.response)
+            self.segments[self.current] += len(entry.response)
+
+            # 2. Record where it went
+            record = {'key': key, 'segment': self.current, 'offset': offset, 'length': len(entry.response),
+                      'expires': entry.expires, 'etag': entry.etag, 'lastModified': entry.lastModified,
+                      'version': entry.version}
+            self.index[key] = record
+            self.writeRecord(record)
+
+            # 3. Keep the disk use within its budget
+            if sum(self.segments.values()) > self.maxBytes:
+                self.evict()
+
+    def touch(self, key, entry):
+        #A revalidated response keeps its bytes, only its expiry and validators change
+        with self.lock:
+            record = self.index.get(key)
+            if record is not None:
+                record = dict(record, expires=entry.expires, etag=entry.etag, lastModified=entry.lastModified)
+                self.index[key] = record
+                self.writeRecord(record)
+
+    def writeRecord(self, record):
+        self.indexFile.write(json.dumps(record) + '\n')
+        self.indexFile.flush()
+
+    def evict(self):
+        # 1. Drop the oldest segments until the rest fits, never the one being written to
+        dropped = False
+        while sum(self.segments.values()) > self.maxBytes and len(self.segments) > 1:
+            oldest = min(self.segments)
+            del self.segments[oldest]
+            self.maps.pop(oldest, None) #views still being sent keep the mapping alive until they are released
+            os.remove(self.segmentPath(oldest))
+            self.evictions += 1
+            dropped = True
+
+        if not dropped:
+            return
+
+        # 2. Rewrite the index with only the entries that still have their bytes
+        self.index = {key: record for key, record in self.index.items() if record['segment'] in self.segments}
+        self.indexFile.close()
+        indexPath = os.path.join(self.directory, 'index')
+        with open(indexPath + '.tmp', 'w') as f:
+            for record in self.index.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(indexPath + '.tmp', indexPath)
+        self.indexFile = open(indexPath, 'a')
+
+    def stats(self):
+        return 'disk cache: %d hits, %d segment evictions, %d objects, %d bytes' % (
+            self.hits, self.evictions, len(self.index), sum(self.segments.values()))
+
+
+class ResponseCache:
+
+    # Dict-backed LRU of origin responses for the proxy, bounded by a byte budget.
+    # Freshness follows the response's Cache-Control/Expires headers, stale entries
+    # stay around so they can be revalidated with If-None-Match/If-Modified-Since.
+    # An optional DiskCache underneath keeps every stored response across restarts
+    # and answers whatever the memory tier no longer holds.
+    def __init__(self, maxBytes, maxObjectSize, defaultTtl, disk=None):
+        self.maxBytes = maxBytes
+        self.maxObjectSize = maxObjectSize
+        self.defaultTtl = defaultTtl
+        self.disk = disk
+        self.entries = OrderedDict() #key -> CachedResponse, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        #Returns the entry even when stale, a stale entry only counts as a miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+
+        with self.lock:
+            if entry is not None and entry.isFresh():
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry
+
+    def put(self, key, entry):
+        if self.disk is not None and len(entry.response) <= self.maxObjectSize:
+            self.disk.put(key, entry)
+
+        if len(entry.response) > min(self.maxObjectSize, self.maxBytes):
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.response)
+
+            self.entries[key] = entry
+            self.size += len(entry.response)
+
+            #Evict the least recently used responses until the cache fits its byte budget again
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.response)
+                self.evictions += 1
+
+    def refresh(self, key, entry, headers):
+        #The origin answered 304 Not Modified, the cached copy is good for another lifetime
+        lifetime = self.lifetime(200, headers)
+        with self.lock:
+            entry.expires = time.time() + (lifetime or 0)
+            entry.etag = headers.get('etag', entry.etag)
+            entry.lastModified = headers.get('last-modified', entry.lastModified)
+            self.revalidations += 1
+
+        if self.disk is not None:
+            self.disk.touch(key, entry)
+
+    def lifetime(self, status, headers, method='GET', authorized=False, uniform=()):
+        #Seconds a response stays fresh, or None when it must not be stored (or shared) at all. Only GET responses are
+        #stored, one to a request carrying credentials only when the origin marked it public, and none setting cookies.
+        #Entries are keyed by URL alone, so neither are responses varying on a request header, bar the uniform ones
+        #sent the same for every client
+        if status != 200 or method != 'GET' or 'set-cookie' in headers:
+            return None
+        varied = {name.strip().lower() for name in headers.get('vary', '').split(',')} - {''} - set(uniform)
+        if varied:
+            return None
+
+        directives = {}
+        for directive in headers.get('cache-control', '').lower().split(','):
+            name, _, value = directive.strip().partition('=')
+            directives[name] = value.strip('"')
+
+        if 'no-store' in directives or 'private' in directives:
+            return None
+        if authorized and 'public' not in directives:
+            return None
+        if 'no-cache' in directives:
+            return 0
+
+        # 1. Explicit lifetimes, shared caches prefer s-maxage
+        for name in ('s-maxage', 'max-age'):
+            if directives.get(name, '').isdigit():
+                return int(directives[name])
+
+        # 2. Absolute expiry, relative to the origin's own clock when it sent one
+        if 'expires' in headers:
+            expires = self.parseDate(headers['expires'])
+            date = self.parseDate(headers.get('date', '')) or time.time()
+            return max(0, expires - date) if expires else 0
+
+        # 3. Nothing said, fall back to the configured default
+        return self.defaultTtl
+
+    def parseDate(self, value):
+        try:
+            return email.utils.mktime_tz(email.utils.parsedate_tz(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def stats(self):
+        stats = 'response cache: %d hits, %d misses, %d revalidated, %d evictions, %d objects, %d bytes' % (
+            self.hits, self.misses, self.revalidations, self.evictions, len(self.entries), self.size)
+        if self.disk is not None:
+            stats += '\n' + self.disk.stats()
+        return stats
+
+
+class UpstreamConnection:
+
+    # A connection to an origin server, read through a buffered reader so response
+    # heads can be read line by line and bodies straight into the relay buffer.
+    def __init__(self, host, port, address, timeout):
+        self.host = host
+        self.port = port
+        self.socket = socket.create_connection((address, port), timeout)
+        self.reader = self.socket.makefile('rb')
+        self.lastUsed = time.monotonic()
+        self.reused = False
+
+    def close(self):
+        self.reader.close()
+        self.socket.close()
+
+
+class ConnectionPool:
+
+    # Keep-alive connections to origin servers, pooled per (host, port). At most
+    # maxPerHost connections to one origin exist at a time, callers wait for one
+    # to be released beyond that, and at most maxIdlePerHost of them are kept
+    # open between requests, for no longer than idleTimeout seconds.
+    def __init__(self, resolver, maxIdlePerHost=4, maxPerHost=16, idleTimeout=30, connectTimeout=10):
+        self.resolver = resolver
+        self.maxIdlePerHost = maxIdlePerHost
+        self.maxPerHost = max(1, maxPerHost)
+        self.idleTimeout = idleTimeout
+        self.connectTimeout = connectTimeout
+        self.idle = {} #(host, port) -> idle connections, most recently used last
+        self.open = {} #(host, port) -> number of connections in use or idle
+        self.created = 0
+        self.reuses = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, host, port):
+        key = (host, port)
+        with self.condition:
+            while True:
+                # 1. Reuse the most recently used idle connection, closing any that sat idle for too long
+                idle = self.idle.get(key, [])
+                while idle:
+                    conn = idle.pop()
+                    if time.monotonic() - conn.lastUsed < self.idleTimeout:
+                        conn.reused = True
+                        self.reuses += 1
+                        return conn
+                    self.discard(conn)
+
+                # 2. Otherwise open a new one if the origin is still under its limit
+                if self.open.get(key, 0) < self.maxPerHost:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    break
+
+                self.condition.wait()
+
+        try:
+            conn = UpstreamConnection(host, port, self.resolver.resolve(host), self.connectTimeout)
+        except BaseException:
+            with self.condition:
+                self.open[key] -= 1
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.created += 1
+        return conn
+
+    def release(self, conn, reusable):
+        #Give a connection back once its response has been read completely, anything else is closed
+        key = (conn.host, conn.port)
+        with self.condition:
+            idle = self.idle.setdefault(key, [])
+            if reusable and len(idle) < self.maxIdlePerHost:
+                conn.lastUsed = time.monotonic()
+                idle.append(conn)
+            else:
+                self.discard(conn)
+            self.condition.notify_all()
+
+    def discard(self, conn):
+        #Called with the condition held
+        conn.close()
+        key = (conn.host, conn.port)
+        self.open[key] -= 1
+
+    def openCount(self):
+        with self.condition:
+            return sum(self.open.values())
+
+    def idleCount(self):
+        with self.condition:
+            return sum(map(len, self.idle.values()))
+
+    def stats(self):
+        return 'upstream pool: %d connections opened, %d reused' % (self.created, self.reuses)
+
+
+class CacheTee:
+
+    # Collects a copy of the bytes relayed to the client for the cache, giving up
+    # (and freeing what it held) as soon as the object outgrows the size limit.
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+
+    def add(self, data):
+        if self.parts is None:
+            return
+        self.size += len(data)
+        if self.size <= self.limit:
+            self.parts.append(bytes(data))
+        else:
+            self.parts = None
+
+    def value(self):
+        if self.parts is None:
+            return None
+        return b''.join(self.parts)
+
+
+class Flight:
+
+    # One origin fetch shared by every client which asked for the same object while
+    # it was in progress. The leader publishes each chunk it relays to its own
+    # client, followers stream the chunks published so far and then wait for more.
+    # Chunks are held while the fetch is within limit bytes, so late followers get
+    # all of it. Past that no follower may join any more, chunks are dropped once
+    # every follower has sent them, and the leader waits for followers more than
+    # limit bytes behind, cutting off one which does not catch up within timeout.
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.chunks = []
+        self.first = 0 #number of chunks dropped from the front of chunks
+        self.size = 0 #bytes held in chunks
+        self.overflowed = False
+        self.followers = {} #follower -> number of the next chunk it sends
+        self.done = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def follow(self):
+        #Returns a new follower, or None once the start of the fetch may have been dropped already
+        with self.condition:
+            if self.overflowed:
+                return None
+            follower = object()
+            self.followers[follower] = 0
+            return follower
+
+    def publish(self, data):
+        with self.condition:
+            self.chunks.append(bytes(data))
+            self.size += len(data)
+            if self.size > self.limit:
+                self.overflowed = True
+            if self.overflowed:
+                self.trim()
+            self.condition.notify_all()
+
+    def trim(self):
+        #Called with the condition held. Drop the chunks every follower has sent, and wait while the slowest one
+        #still needs more than limit bytes
+        deadline = time.monotonic() + self.timeout
         while True:
-            newSocket, clientAddress = s1.accept()
-            #http://vdi-scc203-17:1025/index.html for testing
-            self.handleRequest(newSocket, clientAddress)
-        
-        # 5. Close server socket
-        s1.close()
+            needed = min(self.followers.values(), default=self.first + len(self.chunks))
+            del self.chunks[:needed - self.first]
+            self.first = needed
+            self.size = sum(map(len, self.chunks))
+            if self.size <= self.limit:
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                self.condition.wait(remaining)
+            else:
+                del self.followers[min(self.followers, key=self.followers.get)]
+                deadline = time.monotonic() + self.timeout
+
+    def finish(self, failed):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    def stream(self, tcpSocket, follower):
+        #Send the fetch to a follower as it arrives, returns whether it completed and whether anything was sent
+        sent = False
+        try:
+            while True:
+                with self.condition:
+                    while (follower in self.followers and not self.done
+                           and self.followers[follower] == self.first + len(self.chunks)):
+                        self.condition.wait()
+                    if follower not in self.followers:
+                        return False, sent #cut off for falling too far behind
+                    index = self.followers[follower]
+                    pending = self.chunks[index - self.first:]
+                    done, failed = self.done, self.failed
+
+                for chunk in pending:
+                    tcpSocket.sendall(chunk)
+                    sent = True
+                if done:
+                    return not failed, sent
+
+                #Let the leader drop what was sent
+                with self.condition:
+                    if follower in self.followers:
+                        self.followers[follower] = index + len(pending)
+                        self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.followers.pop(follower, None)
+
+
+class SingleFlight:
+
+    # Registry of the fetches in progress, so concurrent misses for one key make a
+    # single request to the origin instead of one each. Each fetch holds at most
+    # limit bytes for its followers, waiting up to timeout for slow ones.
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.flights = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def join(self, key):
+        #Returns the flight for key and the caller's follower in it, None when the caller leads it (and so has to
+        #fetch). A fetch too far along to be followed leaves the caller to fetch on its own, without a flight
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                follower = flight.follow()
+                if follower is None:
+                    return None, None
+                self.coalesced += 1
+                return flight, follower
+
+            flight = Flight(self.limit, self.timeout)
+            self.flights[key] = flight
+            return flight, None
+
+    def leave(self, key, flight, failed):
+        #Later requests go to the cache (or start a new flight), then whoever followed this one is released
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.finish(failed)
+
+    def stats(self):
+        return 'single flight: %d requests coalesced' % self.coalesced
 
 
 class Proxy(NetworkApplication):
 
     serverPort = 0
-    cache = []
-    urls = []
-
-    def __init__(self, args):
+    relayChunk = 64 * 1024 #size of the reusable buffer responses are relayed through
+    upstreamTimeout = 10
+    maxObjectSize = 1 << 20 #largest response which is kept in the cache
+    maxHeadSize = 64 * 1024
+    maxBodySize = 16 << 20 #largest request body forwarded to an origin
+    hopByHop = (b'connection', b'proxy-connection', b'keep-alive')
+    worker = None #number of this worker process, None unless --workers forks several
+
+    def __init__(self, args, run=True):
         print('Web Proxy starting on port: %i...' % (args.port))
         
         self.serverPort = args.port
+        self.maxObjectSize = args.max_object_size
+        host = args.host or socket.gethostname()
+
+        #With several workers this process only supervises them, every worker carries on from here with a socket of its own
+        if args.workers > 1:
+            self.worker = Supervisor(args.workers, (host, self.serverPort), self.stop).fork()
+            if self.worker is None:
+                return
+
+        #A disk cache directory is only ever written by one process, so every worker keeps its own
+        diskCache = args.disk_cache
+        if diskCache and self.worker is not None:
+            diskCache = os.path.join(diskCache, 'worker-%d' % (self.worker))
+        disk = DiskCache(diskCache, args.disk_cache_size) if diskCache else None
+        self.cache = ResponseCache(args.cache_size, args.max_object_size, args.default_ttl, disk)
+        self.pool = ConnectionPool(self.resolver, args.pool_idle, args.pool_max, args.pool_idle_timeout, self.upstreamTimeout)
+        self.flights = SingleFlight(self.maxObjectSize, self.upstreamTimeout)
+        self.parsers = {} #RequestParser of each open client connection, holding any partly received request
+        self.compression = Compression(args.compression_cache, args.compress_min_size, not args.no_compression)
+        self.startInstrumentation(args)
+        self.metrics.register('response_cache_hits_total', 'counter', lambda: self.cache.hits)
+        self.metrics.register('response_cache_misses_total', 'counter', lambda: self.cache.misses)
+        self.metrics.register('response_cache_revalidations_total', 'counter', lambda: self.cache.revalidations)
+        self.metrics.register('response_cache_evictions_total', 'counter', lambda: self.cache.evictions)
+        self.metrics.register('response_cache_objects', 'gauge', lambda: len(self.cache.entries))
+        self.metrics.register('response_cache_bytes', 'gauge', lambda: self.cache.size)
+        self.metrics.register('upstream_connections_opened_total', 'counter', lambda: self.pool.created)
+        self.metrics.register('upstream_connections_reused_total', 'counter', lambda: self.pool.reuses)
+        self.metrics.register('upstream_connections_open', 'gauge', self.pool.openCount)
+        self.metrics.register('upstream_connections_idle', 'gauge', self.pool.idleCount)
+        self.metrics.register('flights_in_progress', 'gauge', lambda: len(self.flights.flights))
+        self.metrics.register('requests_coalesced_total', 'counter', lambda: self.flights.coalesced)
+        self.metrics.register('compressed_variant_hits_total', 'counter', lambda: self.compression.hits)
+        self.metrics.register('compressed_variant_misses_total', 'counter', lambda: self.compression.misses)
+        self.metrics.register('compressed_variant_bytes', 'gauge', lambda: self.compression.size)
   
         #Creates the first connection sockets binding it to a host and a port, due to it being a proxy it is better to do this.
         s1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        host = socket.gethostname()
+        if self.worker is not None:
+            s1.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s1.bind((host, self.serverPort))
+        self.serverSocket = s1
+        self.address = s1.getsockname()
         print("Socket has been initialized")
         
         print(host)
         print(self.serverPort)
 
-        #Following loop allows the socket to listen for requests and call the function connect, which handles said requests, if any are to arise.
-        while 1:
-            
-            s1.listen(1)
-            try:
-                conn, addr = s1.accept()
-                # 1. Receive request message from the client on connection socket
-                data = conn.recv(4096)
-                #self.connect(conn, data, addr, s1)
-                self.requestHandler(conn, data, addr)
-            except KeyboardInterrupt:
-                
-                s1.close()
-                print('Action terminated by Ctrl+C')
+        #The engine listens for requests and calls handleConnection, which hands them to requestHandler, serving many clients at once
+        s1.listen(args.backlog)
+        self.engine = ConnectionEngine(self.handleConnection, self.parse, args.mode, args.threads, args.max_connections,
+                                       self.upstreamTimeout, self.connectionClosed, self.metrics)
+        print('Serving in %s mode (backlog %d, max %d connections)' % (args.mode, args.backlog, args.max_connections))
+
+        #Left to the caller when run is False, e.g. to serve from a thread of its own
+        if run:
+            self.run()
+
+    def run(self):
+        self.engine.serve(self.serverSocket)
+
+        print(self.cache.stats())
+        print(self.pool.stats())
+        print(self.flights.stats())
+        print(self.compression.stats())
+        print(self.resolver.stats())
+        self.stopInstrumentation()
+
+    def stop(self):
+        self.engine.stop()
+
+    def parse(self, tcpSocket, data):
+        # 1. Receive request message from the client on connection socket, however many reads it takes
+        parser = self.parsers.get(tcpSocket)
+        if parser is None:
+            parser = self.parsers[tcpSocket] = RequestParser(self.maxHeadSize, self.maxBodySize)
+        try:
+            return parser.feed(data)
+        except HttpError as e:
+            self.refuse(tcpSocket, e.status)
+            return None
 
-        s1.close()
+    def connectionClosed(self, tcpSocket):
+        self.parsers.pop(tcpSocket, None)
 
-    def requestHandler(self, tcpSocket, rawData, addr):
+    def handleConnection(self, tcpSocket, addr, requests):
+        self.metrics.adjust('requests_in_flight', 1)
+        try:
+            self.requestHandler(tcpSocket, requests[0], addr)
+        finally:
+            self.metrics.adjust('requests_in_flight', -1)
+
+        #Every client connection carries a single request
+        return False
+
+    def requestHandler(self, tcpSocket, request, addr):
         
+        started = time.perf_counter()
         
         # 2. Extract the path of the requested object from the message (second part of the HTTP header)
-
-        firstTrim = rawData.decode('utf-8').split('\n')[0]
-
-        url = firstTrim.split(' ')[1]
+        method = request.method
+        url = request.target
+
+        #Metrics and profiles are answered by the proxy itself
+        report = self.instrumentation(url)
+        if report is not None:
+            body = report.encode()
+            tcpSocket.sendall(b'HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n'
+                              b'Connection: close\r\n\r\n' % len(body) + body)
+            tcpSocket.close()
+            return
         
-        #Removing the initial "http://" and the terminating "/" by use of find and trimming
-        temp = url.find("://") + 3
-        url = url[temp:-1]
+        #Removing the initial "http://", the rest (host, optional port and path) is the cache key. A request
+        #with only a path names the host in its Host header instead
+        if '://' in url:
+            temp = url.find("://") + 3
+            url = url[temp:]
+        else:
+            url = request.headers.get('host', '') + url
 
-        #Assigning a port
-        port = 80
+        #Assigning a port, 80 unless the URL names one
+        host, port = self.splitHost(url)
+        if not host:
+            self.refuse(tcpSocket, '400 Bad Request')
+            return
 
         #Printing out the address for debugging
         print(url)
 
-        #If statement to ensure the addr is not in cache, if it is fetch from cache and send, if not just recv, store and send
-        if url in self.urls:
+        #The coding this client gets compressible responses in, if any
+        encoding = self.compression.negotiate(request.headers.get('accept-encoding', '')) if method == 'GET' else None
+
+        #If the addr is cached and still fresh answer from the cache, otherwise fetch it (revalidating a stale copy), relay and store it.
+        #Entries are keyed by URL alone and hold GET responses, which also answer HEAD. Other methods always go to the origin
+        entry = None
+        if method in ('GET', 'HEAD'):
+            lookup = self.metrics.start()
+            entry = self.cache.get(url)
+            self.metrics.observe('cache_lookup', lookup)
+        if entry is not None and entry.isFresh():
             
             print("Addr is in cache. Fetching ...")
-            tempIndex = self.urls.index(url)
 
-            tcpSocket.send(str.encode('HTTP/1.0 200 OK\r\n\r\n'))
-            tcpSocket.send(self.cache[tempIndex])
+            #The cached bytes are the origin's complete response, status line included, or a compressed variant of it.
+            #A HEAD request gets only its status line and headers
+            response = self.encodedResponse(url, entry, encoding)
+            if method == 'HEAD':
+                response = self.headOf(response)
+            sending = self.metrics.start()
+            tcpSocket.sendall(response)
+            self.metrics.observe('send', sending)
+            print(f"REQUEST DONE: {addr[0]}")
+
+            tcpSocket.close()
+            cache, status, size = 'hit', self.statusOf(entry.response), len(response)
 
-            data = self.cache[tempIndex]
+        else:
+
+            #A stale GET response is not revalidated for a HEAD, whose body-less answer could not refresh it
+            if method != 'GET':
+                entry = None
+
+            # 3. Join the fetch of this object if another client already started one, otherwise lead it. Requests whose
+            #    answer depends on more than the URL (a byte range, credentials or cookies) are fetched on their own
+            flight, follower = None, None
+            if method == 'GET' and not any(name in request.headers for name in ('range', 'authorization', 'cookie')):
+                flight, follower = self.flights.join(url)
+            leader = follower is None
+
+            if not leader:
+                print("Addr is being fetched already. Coalescing ...")
+                try:
+                    completed, sent = flight.stream(tcpSocket, follower)
+                except Exception as e:
+                    print(e)
+                    completed, sent = False, True
+
+                #The leader failed or left this client behind before sending anything, fetch it separately instead
+                if not completed and not sent:
+                    flight, leader = None, True
+                else:
+                    tcpSocket.close()
+                    print(f"REQUEST DONE: {addr[0]} (coalesced)" if completed else "REQUEST NOT DONE (coalesced)")
+                    cache, status, size = 'coalesced', None, None
+
+            if leader:
+                status, size = self.fetch(tcpSocket, request, url, host, port, entry, flight, addr, encoding)
+                cache = 'miss' if entry is None else 'revalidated' if status == 304 else 'stale'
+
+        self.metrics.count('requests_total{cache="%s"}' % (cache))
+        self.metrics.count('bytes_sent_total', size or 0)
+        self.emit('request', host=addr[0], method=method, path=url, status=status, cache=cache, bytes=size,
+                  duration=(time.perf_counter() - started) * 1000)
+        print("-------------------------------------------------------------------------------------------") 
+
+    def refuse(self, tcpSocket, status):
+        #Answer a request which could not be parsed or routed and close the connection
+        body = ('Error %s' % status).encode()
+        tcpSocket.settimeout(self.upstreamTimeout)
+        tcpSocket.sendall(('HTTP/1.1 %s\r\nContent-Type: text/html\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                           % (status, len(body))).encode() + body)
+        tcpSocket.close()
+        print(status)
+
+    def splitHost(self, url):
+        #Host and port of a URL with its scheme taken off
+        authority = url.split('/', 1)[0]
+        host, _, port = authority.partition(':')
+        return host, int(port) if port.isdigit() else 80
+
+    def statusOf(self, response):
+        #Status code of a complete response, from its status line. Disk cache hits are memoryviews
+        code = bytes(response[9:12])
+        return int(code) if code.isdigit() else None
+
+    def headOf(self, response):
+        #Status line and headers of a complete response, up to and including the blank line ending them
+        end = bytes(response[:self.maxHeadSize]).find(b'\r\n\r\n')
+        return response if end < 0 else response[:end + 4]
+
+    def fetch(self, tcpSocket, request, url, host, port, entry, flight, addr, encoding=None):
+        #Returns the origin's status code and the size of the response relayed (None where it is not known)
+        if entry is None:
+            print("Addr is not in cache. Storing ...")
+        else:
+            print("Cached copy is stale. Revalidating ...")
+
+        method = request.method
+        failed = True
+        try:
+            # 4. Send the request over a pooled connection, conditional on the validators of a stale copy
+            conn, head = self.sendUpstream(host, port, self.upstreamRequest(request, url, self.conditionalHeaders(entry)))
+            status, headers = self.parseResponseHead(head)
+
+            #Coalesced followers may only share a response the cache could store too, otherwise they are let go before
+            #anything is published and fetch their own
+            lifetime = self.cache.lifetime(status, headers, method, 'authorization' in request.headers, self.uniformHeaders())
+            if flight is not None and lifetime is None and not (entry is not None and status == 304):
+                self.flights.leave(url, flight, True)
+                flight = None
+
+            try:
+                if entry is not None and status == 304:
+
+                    # 5. The stale copy is still valid, serve it and keep it for another lifetime
+                    self.cache.refresh(url, entry, headers)
+                    if flight is not None:
+                        flight.publish(entry.response)
+                    data = self.encodedResponse(url, entry, encoding)
+                    tcpSocket.sendall(data)
+                    reusable = self.keepsAlive(head, headers)
+
+                else:
+
+                    # 5. Relay the response to the client (and any coalesced followers) as it arrives, tee-ing it into the cache
+                    relaying = self.metrics.start()
+                    data, reusable, variant = self.relay(conn, tcpSocket, method, head, status, headers, flight, encoding)
+                    self.metrics.observe('relay', relaying)
+
+                    #Storing in the cache, unless the response was too large or the origin does not allow it, along with
+                    #the compressed variant the client was sent
+                    if data and lifetime is not None:
+                        stored = CachedResponse(data, time.time() + lifetime, headers.get('etag'), headers.get('last-modified'))
+                        self.cache.put(url, stored)
+                        if variant is not None:
+                            self.compression.put(url, encoding, stored.version, variant)
+            except BaseException:
+                self.pool.release(conn, False)
+                raise
+
+            # 8. Close the client socket and give the upstream connection back to the pool if it can carry another request
+            tcpSocket.close()
+            self.pool.release(conn, reusable)
+            failed = False
+
+            #Print message regarding the request (i.e is it or not done)
+            if data is None or len(data) > 0:
 
-            if(len(data) > 0):
                 print(f"REQUEST DONE: {addr[0]}")
-                print(f"DATA FETCHED FROM LIST INDEX {tempIndex}")
             else:
                 print("REQUEST NOT DONE")
+            return status, (len(data) if data is not None else None)
 
+        except Exception as e:
+            
+            print(e)
             tcpSocket.close()
+            return None, None
 
-        else:
+        finally:
+            if flight is not None:
+                self.flights.leave(url, flight, failed)
 
-            print("Addr is not in cache. Storing ...")
-            proxySocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def sendUpstream(self, host, port, request):
+        #Returns the connection and the head of its response. A pooled connection may have been closed by the
+        #origin while it sat idle, which only shows once nothing comes back, so that case is retried on a new one
+        while True:
+            started = self.metrics.start()
+            conn = self.pool.acquire(host, port)
+            self.metrics.observe('upstream_connect', started)
             try:
-                # 3. Connect to socket and send the request
-                proxySocket.connect((url, 80))
-                proxySocket.sendall(rawData)
-            
-                # 4. Receive data on socket after sending request
-                data = proxySocket.recv(99999)
-                
-                # 5. Send the correct HTTP response error
-                tcpSocket.send(str.encode('HTTP/1.0 200 OK\r\n\r\n'))
+                started = self.metrics.start()
+                conn.socket.sendall(request)
+                head = self.readResponseHead(conn.reader)
+                self.metrics.observe('upstream_response', started)
+            except OSError:
+                if not conn.reused:
+                    self.pool.release(conn, False)
+                    raise
+                head = b''
+
+            if head:
+                return conn, head
+            self.pool.release(conn, False)
+            if not conn.reused:
+                raise ConnectionError('origin closed the connection without a response')
+
+    def conditionalHeaders(self, entry):
+        headers = []
+        if entry is not None and entry.etag:
+            headers.append(b'If-None-Match: ' + entry.etag.encode('iso-8859-1'))
+        if entry is not None and entry.lastModified:
+            headers.append(b'If-Modified-Since: ' + entry.lastModified.encode('iso-8859-1'))
+        return headers
+
+    def readResponseHead(self, reader):
+        #Read the status line and headers up to the blank line ending them
+        head = bytearray()
+        while len(head) < self.maxHeadSize:
+            line = reader.readline(self.maxHeadSize)
+            head += line
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return bytes(head)
+
+    def parseResponseHead(self, head):
+        #Returns the status code (0 if unreadable) and the headers keyed by lower case name
+        lines = head.decode('iso-8859-1').split('\r\n')
+        statusLine = lines[0].split()
+        status = int(statusLine[1]) if len(statusLine) > 1 and statusLine[1].isdigit() else 0
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(':')
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+        return status, headers
+
+    def keepsAlive(self, head, headers):
+        connection = headers.get('connection', '').lower()
+        if head.startswith(b'HTTP/1.0'):
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def relay(self, conn, tcpSocket, method, head, status, headers, flight=None, encoding=None):
+        #Copy the origin's response to the client chunk by chunk through one reusable buffer, so memory stays flat
+        #whatever the size of the response. Returns the whole response for the cache (None once it outgrew
+        #maxObjectSize), whether the upstream connection ended cleanly on a response boundary and the compressed
+        #response the client got instead (None if it was not compressed or outgrew the variant size limit)
+        buffer = bytearray(self.relayChunk)
+        view = memoryview(buffer)
+        tee = CacheTee(self.maxObjectSize)
+        reusable = self.keepsAlive(head, headers)
+
+        #A compressible body is compressed as it streams through for a client accepting it. Its length is not known
+        #until the end, which is fine as the client connection closes after the response anyway
+        compressor = None
+        length = headers.get('content-length', '')
+        if (encoding is not None and status == 200 and method == 'GET' and 'content-encoding' not in headers
+                and self.compression.accepts(headers.get('content-type', ''), int(length) if length.isdigit() else None)):
+            compressor = self.compression.compressor(encoding)
+            compressed = CacheTee(self.compression.maxObjectSize)
+
+        def forward(data, framing=False):
+            # 5. Hand each chunk to coalesced followers first, so they are not held up by a slow leading client
+            if flight is not None:
+                flight.publish(data)
+
+            # 6. Forward it straight away so the client's first byte does not wait for the last, compressing only the
+            #    body itself and leaving out the origin's framing
+            if compressor is None:
+                tcpSocket.sendall(data)
+            elif not framing:
+                coded = compressor.compress(data)
+                if coded:
+                    tcpSocket.sendall(coded)
+                    compressed.add(coded)
+
+            # 7. Keep a copy for the cache while the object is still small enough to be cached
+            tee.add(data)
+
+        def forwardExactly(length):
+            while length > 0:
+                received = conn.reader.readinto(view[:min(length, len(buffer))])
+                if received == 0:
+                    raise ConnectionError('origin closed the connection mid response')
+                forward(view[:received])
+                length -= received
+
+        #The client connection is closed after this response whatever the origin said
+        clientHead = self.clientHead(head)
+        if compressor is not None:
+            tcpSocket.sendall(self.encodedHead(clientHead, encoding))
+        forward(clientHead, True)
+
+        # 4. Find out how the body is framed, and relay exactly that much of it
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+
+        elif 'chunked' in headers.get('transfer-encoding', '').lower():
+            while True:
+                line = conn.reader.readline(self.maxHeadSize)
+                forward(line, True)
+                size = int(line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    break
+                forwardExactly(size)
+                forward(conn.reader.readline(self.maxHeadSize), True) #the CRLF after the chunk data
+
+            #Trailers, up to the blank line closing the body
+            while True:
+                line = conn.reader.readline(self.maxHeadSize)
+                forward(line, True)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+        elif headers.get('content-length', '').isdigit():
+            forwardExactly(int(headers['content-length']))
 
-                # 6. Send the content of the file to the socket
-                tcpSocket.send(data)
+        else:
+            #No framing, the body runs until the origin closes the connection
+            reusable = False
+            while True:
+                received = conn.reader.readinto(buffer)
+                if not received:
+                    break
+                forward(view[:received])
+
+        #The rest of the compressed body, then the whole compressed response as it would be kept in the cache
+        variant = None
+        if compressor is not None:
+            coded = compressor.flush()
+            tcpSocket.sendall(coded)
+            compressed.add(coded)
+            body = compressed.value()
+            if body is not None:
+                variant = self.encodedHead(clientHead, encoding, len(body)) + body
+        return tee.value(), reusable, variant
+
+    def encodedResponse(self, url, entry, encoding):
+        #The cached response compressed with encoding when the client accepts it and it is worth it, from the
+        #variant cache or compressed once and kept there, otherwise the cached response as it is
+        if encoding is None:
+            return entry.response
+
+        # 1. This version of the object was found not worth compressing before, or a hot one was compressed already
+        version = entry.version
+        if self.compression.isRefused(url, version):
+            return entry.response
+        variant = self.compression.get(url, encoding, version)
+        if variant is not None:
+            return variant
+
+        # 2. Otherwise only complete 200 responses of a compressible type which are not coded already qualify, which
+        #    the head alone tells before anything is copied
+        head = bytes(self.headOf(entry.response))
+        status, headers = self.parseResponseHead(head)
+        chunked = 'chunked' in headers.get('transfer-encoding', '').lower()
+        length = headers.get('content-length', '')
+        if (status != 200 or 'content-encoding' in headers or not self.compression.accepts(
+                headers.get('content-type', ''), int(length) if length.isdigit() and not chunked else None)):
+            self.compression.refuse(url, version)
+            return entry.response
+
+        # 3. Compress it with a head saying so, and keep it for the next client
+        body = bytes(entry.response[len(head):])
+        if chunked:
+            body = self.dechunk(body)
+            if not self.compression.accepts(headers.get('content-type', ''), len(body)):
+                self.compression.refuse(url, version)
+                return entry.response
+        body = self.compression.compress(encoding, [body])
+        variant = self.encodedHead(head, encoding, len(body)) + body
+        self.compression.put(url, encoding, version, variant)
+        return variant
+
+    def encodedHead(self, head, encoding, length=None):
+        #Response head for the body compressed with encoding, framed by its length or, while that is not known yet,
+        #by closing the connection. The ETag is weakened as the bytes are no longer the origin's
+        lines = []
+        for line in head.rstrip(b'\r\n').split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            name = name.strip().lower()
+            if name in (b'content-length', b'transfer-encoding'):
+                continue
+            if name == b'etag' and not value.strip().startswith(b'W/'):
+                line = b'ETag: W/' + value.strip()
+            lines.append(line)
+        lines.append(b'Content-Encoding: ' + encoding.encode())
+        lines.append(b'Vary: Accept-Encoding')
+        if length is not None:
+            lines.append(b'Content-Length: %d' % length)
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def dechunk(self, body):
+        #Body of a chunked response with the framing and any trailers taken off
+        parts, position = [], 0
+        while position < len(body):
+            end = body.index(b'\r\n', position)
+            size = int(body[position:end].split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                break
+            parts.append(body[end + 2:end + 2 + size])
+            position = end + 2 + size + 2
+        return b''.join(parts)
+
+    def uniformHeaders(self):
+        #Request headers the origin gets the same from every client, so a response varying on them suits them all
+        return ('accept-encoding',) if self.compression.enabled else ()
+
+    def upstreamRequest(self, request, url, extraHeaders=()):
+        #Ask the origin to keep the connection open after its response so it can go back to the pool. The request
+        #line carries only the path, and a body (de-chunked by the parser) is sent with its length. While the proxy
+        #compresses responses itself it asks for them uncoded, so the one copy it caches suits every client
+        authority, _, path = url.partition('/')
+        lines = [('%s /%s %s' % (request.method, path, request.version)).encode('iso-8859-1')]
+        dropped = self.hopByHop + (b'content-length', b'transfer-encoding')
+        if self.compression.enabled:
+            dropped += (b'accept-encoding',)
+        for name, value in request.headerLines:
+            if name.lower().encode() not in dropped:
+                lines.append(('%s: %s' % (name, value)).encode('iso-8859-1'))
+        if 'host' not in request.headers:
+            lines.append(b'Host: ' + authority.encode('iso-8859-1'))
+        if request.body or 'content-length' in request.headers or 'transfer-encoding' in request.headers:
+            lines.append(b'Content-Length: %d' % len(request.body))
+        lines.extend(extraHeaders)
+        lines.append(b'Connection: keep-alive')
+        return b'\r\n'.join(lines) + b'\r\n\r\n' + request.body
+
+    def clientHead(self, head):
+        #The proxy answers one request per client connection, so tell the client it is closed after this response
+        lines = [line for line in head.rstrip(b'\r\n').split(b'\r\n') if line.split(b':', 1)[0].strip().lower() not in self.hopByHop]
+        lines.append(b'Connection: close')
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+class BenchOrigin(http.server.BaseHTTPRequestHandler):
+
+    # Stand-in origin for benchmarking the proxy, answering GET /<size> with that
+    # many bytes, cacheable for an hour.
+    protocol_version = 'HTTP/1.1'
+    bodies = {} #size -> body
+
+    def do_GET(self):
+        tail = self.path.rstrip('/').rsplit('/', 1)[-1]
+        size = int(tail) if tail.isdigit() else 0
+        body = self.bodies.get(size)
+        if body is None:
+            body = self.bodies[size] = bytes(size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.send_header('Cache-Control', 'max-age=3600')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-                # 7. Close the socket
-                tcpSocket.close()
-                proxySocket.close()
 
-                #Print message regarding the request (i.e is it or not done)
-                if(len(data) > 0):
+class Benchmark(NetworkApplication):
 
-                    print(f"REQUEST DONE: {addr[0]}")
+    # Load generator for the web server and the proxy. The server under test runs
+    # in this process on loopback (the proxy in front of a stand-in origin), and
+    # clients keep-alive connections request a mix of object sizes for a fixed
+    # time. Reports throughput, latency percentiles and the cache hit ratio.
+    def __init__(self, args):
+        sizes = [int(size) for size in args.sizes.split(',')]
+        print('Benchmarking %s in %s mode: %d clients for %.1fs, object sizes %s bytes...' % (
+            args.target, args.mode, args.clients, args.duration, '/'.join(map(str, sizes))))
+
+        # 1. Start the server under test, with its own console output silenced so it does not skew the numbers
+        with tempfile.TemporaryDirectory(prefix='.bench-', dir='.') as directory, open(os.devnull, 'w') as quiet:
+            with contextlib.redirect_stdout(quiet):
+                server, origin, paths = self.startServer(args, sizes, directory)
+                thread = threading.Thread(target=server.run, daemon=True)
+                thread.start()
+
+                # 2. Drive it with every client at once until the time is up
+                try:
+                    stats, errors, received, elapsed = self.drive(server.address, paths, args.clients, args.duration)
+                finally:
+                    server.stop()
+                    thread.join()
+                    if origin is not None:
+                        origin.shutdown()
+                        origin.server_close()
+
+        # 3. Report throughput, latency and how well the server's cache did
+        cache = server.fileCache if args.target == 'web' else server.cache
+        lookups = cache.hits + cache.misses
+        print('%d requests, %d errors in %.2fs' % (stats.received, errors, elapsed))
+        print('%.1f requests/sec, %.2f MB/sec' % (stats.received / elapsed, received / elapsed / 1e6))
+        print('latency min/avg/max = %.2f/%.2f/%.2f ms' % (stats.minimum, stats.mean, stats.maximum))
+        print('latency p50/p90/p99 = %.2f/%.2f/%.2f ms' % (stats.quantile(0.5), stats.quantile(0.9), stats.quantile(0.99)))
+        print('cache hit ratio = %.2f%% (%d hits, %d misses)' % (
+            cache.hits / lookups * 100 if lookups else 0, cache.hits, cache.misses))
+
+    def startServer(self, args, sizes, directory):
+        #Returns the server under test, the stand-in origin (None for the web server) and the paths to request
+        serverArgs = argparse.Namespace(**vars(args))
+        serverArgs.host, serverArgs.port = '127.0.0.1', 0
+
+        if args.target == 'web':
+            paths = []
+            for size in sizes:
+                path = os.path.join(directory, str(size))
+                with open(path, 'wb') as f:
+                    f.write(os.urandom(size))
+                paths.append('/' + os.path.relpath(path).replace(os.sep, '/'))
+            return WebServer(serverArgs, run=False), None, paths
+
+        origin = http.server.ThreadingHTTPServer(('127.0.0.1', 0), BenchOrigin)
+        origin.daemon_threads = True
+        threading.Thread(target=origin.serve_forever, daemon=True).start()
+        paths = ['http://127.0.0.1:%d/%d' % (origin.server_address[1], size) for size in sizes]
+        return Proxy(serverArgs, run=False), origin, paths
+
+    def drive(self, address, paths, clients, duration):
+        #Returns the latency statistics, the number of failed requests, the bytes received and the time taken
+        stats = RttStats()
+        totals = {'errors': 0, 'bytes': 0}
+        lock = threading.Lock()
+        started = time.monotonic()
+        deadline = started + duration
+
+        def client(number):
+            choose = random.Random(number).choice
+            conn = reader = None
+            while time.monotonic() < deadline:
+                path = choose(paths)
+                begin = time.perf_counter()
+                try:
+                    # 1. Open a connection only when the last one was closed, otherwise keep reusing it
+                    if conn is None:
+                        conn = socket.create_connection(address)
+                        reader = conn.makefile('rb')
+                    conn.sendall(('GET %s HTTP/1.1\r\nHost: %s:%d\r\n\r\n' % (path, address[0], address[1])).encode())
+
+                    # 2. Read the response, its head and then exactly Content-Length bytes of body
+                    status = reader.readline()
+                    length, keepAlive = 0, True
+                    while True:
+                        line = reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('iso-8859-1').partition(':')
+                        if name.strip().lower() == 'content-length':
+                            length = int(value)
+                        elif name.strip().lower() == 'connection':
+                            keepAlive = value.strip().lower() != 'close'
+                    body = reader.read(length)
+                    if not status.split()[1:2] == [b'200'] or len(body) != length:
+                        raise ConnectionError('bad response to %s' % (path))
+                except (OSError, IndexError, ValueError):
+                    with lock:
+                        totals['errors'] += 1
+                    keepAlive = False
                 else:
-                    print("REQUEST NOT DONE")
+                    with lock:
+                        stats.probe()
+                        stats.add((time.perf_counter() - begin) * 1000)
+                        totals['bytes'] += length
 
-            except Exception as e:
-                
-                print(e)
-                tcpSocket.close()
-                proxySocket.close()
+                if not keepAlive and conn is not None:
+                    reader.close()
+                    conn.close()
+                    conn = reader = None
 
-            #Appending to cache
-            self.urls.append(url)
-            self.cache.append(data)
+            if conn is not None:
+                reader.close()
+                conn.close()
 
-        print("-------------------------------------------------------------------------------------------") 
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stats, totals['errors'], totals['bytes'], time.monotonic() - started
 
 
 if __name__ == "__main__":
     args = setupArgumentParser()
-    args.func(args)
+    if args.output == 'text':
+        args.func(args)
+    else:
+        stream = open(args.output_file, 'w', newline='') if args.output_file else sys.stdout
+        NetworkApplication.output = OutputSink(stream, args.output, path=args.output_file)
+
+        #SIGTERM stops the application like Ctrl+C, so the records still buffered are written out before it exits
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            #Records written to standard output move the human readable text to standard error
+            with contextlib.redirect_stdout(sys.stderr if stream is sys.stdout else sys.stdout):
+                args.func(args)
+        finally:
+            NetworkApplication.output.close()